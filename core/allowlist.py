@@ -0,0 +1,93 @@
+import ipaddress
+import logging
+import os
+import threading
+from collections import Counter
+from fire_config import LOG_FILE_NAME, ALLOWLIST_FILE_PATH
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+# Trie node layout: [child for bit 0, child for bit 1, allowlist entry ending here]
+_ZERO, _ONE, _ENTRY = 0, 1, 2
+
+
+class Allowlist:
+    """Binary prefix tree of allowlisted CIDRs, looked up in O(prefix length)"""
+
+    def __init__(self):
+        self._roots = {4: [None, None, None], 6: [None, None, None]}
+        self.entry_count = 0
+        self.suppressed = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, allowlist_file_name=ALLOWLIST_FILE_PATH):
+        allowlist = cls()
+        if not os.path.exists(allowlist_file_name):
+            logging.info(f"Allowlist file {allowlist_file_name} does not exist, nothing is excluded.")
+            return allowlist
+
+        with open(allowlist_file_name, "r") as allowlist_file:
+            for line_no, line in enumerate(allowlist_file, start=1):
+                entry = line.split("#", 1)[0].strip()
+                if not entry:
+                    continue
+                try:
+                    allowlist.add(entry)
+                except ValueError as err:
+                    logging.error(f"Invalid allowlist entry on line {line_no}: {err}")
+
+        logging.info(f"Allowlist loaded with {allowlist.entry_count} entries.")
+        return allowlist
+
+    def add(self, cidr):
+        """Function to insert a CIDR into the prefix tree"""
+        network = ipaddress.ip_network(cidr, strict=False)
+        node = self._roots[network.version]
+        address = int(network.network_address)
+        max_bits = network.max_prefixlen
+        for depth in range(network.prefixlen):
+            bit = (address >> (max_bits - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[_ENTRY] is None:
+            self.entry_count += 1
+        node[_ENTRY] = str(network)
+
+    def match(self, ip_address):
+        """Function to return the most specific allowlist entry covering the IP, or None"""
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        node = self._roots[address.version]
+        value = int(address)
+        max_bits = address.max_prefixlen
+        matched = node[_ENTRY]
+        for depth in range(max_bits):
+            node = node[(value >> (max_bits - 1 - depth)) & 1]
+            if node is None:
+                break
+            if node[_ENTRY] is not None:
+                matched = node[_ENTRY]
+        return matched
+
+    def suppress(self, ip_address):
+        """Function to check an IP against the allowlist and count it when suppressed"""
+        entry = self.match(ip_address)
+        if entry is not None:
+            with self._lock:
+                self.suppressed[entry] += 1
+            return True
+        return False
+
+    def report(self):
+        """Function to log how many candidates were suppressed and by which entries"""
+        logging.info(f"Allowlist suppressed {sum(self.suppressed.values())} candidates.")
+        for entry, count in self.suppressed.most_common():
+            logging.info(f"Allowlist entry {entry} suppressed {count} candidates.")
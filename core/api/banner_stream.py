@@ -0,0 +1,54 @@
+import json
+import ijson
+
+BANNER_FIELDS = ("ip_address", "scan_dtime")
+RESULT_PREFIX = "data.result.item"
+META_PREFIXES = {"status": "status", "data.count": "count"}
+_CONTAINER_START = ("start_map", "start_array")
+
+
+def parse_banner_response(response, fields=BANNER_FIELDS):
+    """Function to stream a banner search page and keep only the projected fields of each result"""
+    # Decode gzip/deflate on the fly so the parser reads the body straight off the socket
+    response.raw.decode_content = True
+    return parse_banner_stream(response.raw, fields)
+
+
+def parse_banner_stream(stream, fields=BANNER_FIELDS):
+    """Function to parse a banner search body from a file-like object into (meta, results)"""
+    field_prefixes = {f"{RESULT_PREFIX}.{field}": field for field in fields}
+    meta = {}
+    results = []
+    item = None
+    builder = None
+    builder_prefix = None
+    try:
+        # yajl2_c tokenizes in C; banners and certificates are never built into dicts
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            if builder is not None:
+                # A projected field holding an object or array, e.g. tags, is built in full
+                builder.event(event, value)
+                if prefix == builder_prefix and event in ("end_map", "end_array"):
+                    item[field_prefixes[builder_prefix]] = builder.value
+                    builder = None
+            elif prefix in field_prefixes:
+                if item is None:
+                    continue
+                if event in _CONTAINER_START:
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    builder_prefix = prefix
+                else:
+                    item[field_prefixes[prefix]] = value
+            elif prefix == RESULT_PREFIX:
+                if event == "start_map":
+                    item = dict.fromkeys(fields)
+                elif event == "end_map":
+                    results.append(item)
+                    item = None
+            elif prefix in META_PREFIXES and event not in _CONTAINER_START:
+                meta[META_PREFIXES[prefix]] = value
+    except ijson.JSONError as err:
+        # Keep the JSONDecodeError retry path of process_query
+        raise json.JSONDecodeError(str(err), "", 0) from err
+    return meta, results
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from fire_config import (
+    LOG_FILE_NAME,
+    date,
+    CIP_BUDGET_FILE_PATH,
+    CIP_DAILY_CREDIT_LIMIT,
+    CIP_CREDITS_PER_REQUEST,
+    CIP_QUOTA_HEADER,
+)
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+RESULTS_PER_PAGE = 10
+MAX_PAGES = 9900 // RESULTS_PER_PAGE + 1  # Criminal IP rejects offsets above 9900
+DEFAULT_QUERY_YIELD = 1.0  # New IPs per credit assumed for queries without history
+
+
+def pages_for_count(result_count):
+    """Function to estimate the number of pages needed to read a query's results"""
+    if not result_count:
+        return 0
+    return min(int(result_count / RESULTS_PER_PAGE) + 1, MAX_PAGES)
+
+
+class CreditBudget:
+    """Criminal IP credit accounting per query and per run, with yield-ranked crawl planning"""
+
+    def __init__(
+        self,
+        daily_limit=CIP_DAILY_CREDIT_LIMIT,
+        budget_file_name=CIP_BUDGET_FILE_PATH,
+        credits_per_request=CIP_CREDITS_PER_REQUEST,
+    ):
+        self.daily_limit = daily_limit
+        self.budget_file_name = budget_file_name
+        self.credits_per_request = credits_per_request
+        self.used_today = 0
+        self.history = {}
+        self.counts = {}
+        self.page_limits = {}
+        self.first_pages = {}
+        self.run_credits = Counter()
+        self.run_new_ips = Counter()
+        self._templates = {}
+        self.quota_remaining = None
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(budget_file_name):
+            try:
+                with open(budget_file_name, "r") as budget_file:
+                    state = json.load(budget_file)
+                self.history = state.get("history", {})
+                if state.get("date") == date:
+                    self.used_today = state.get("used_today", 0)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.error(f"Error reading credit budget state: {str(e)}")
+
+    def bind(self, query, template):
+        """Function to account a rendered query under its query file entry"""
+        self._templates[query] = template
+
+    def _key(self, query):
+        return self._templates.get(query, query)
+
+    def remaining(self):
+        """Function to return the credits left today, or None when there is no limit"""
+        limits = []
+        if self.daily_limit is not None:
+            limits.append(self.daily_limit - self.used_today)
+        if self.quota_remaining is not None:
+            limits.append(self.quota_remaining)
+        return min(limits) if limits else None
+
+    def can_spend(self):
+        """Function to check if another request fits in the budget"""
+        if self.exhausted:
+            return False
+        remaining = self.remaining()
+        return remaining is None or remaining >= self.credits_per_request
+
+    def charge(self, query, headers=None):
+        """Function to account for one request and pick up the quota reported by the API"""
+        with self._lock:
+            self.used_today += self.credits_per_request
+            self.run_credits[self._key(query)] += self.credits_per_request
+            value = headers.get(CIP_QUOTA_HEADER) if headers is not None else None
+            if value is not None:
+                try:
+                    self.quota_remaining = int(value)
+                except ValueError:
+                    logging.warning(f"Unexpected {CIP_QUOTA_HEADER} header value: {value}")
+        if self.quota_remaining is not None and self.quota_remaining <= 0:
+            self.mark_exhausted(f"{CIP_QUOTA_HEADER} reported {self.quota_remaining}")
+
+    def mark_exhausted(self, reason):
+        """Function to stop spending credits for the rest of the run"""
+        if not self.exhausted:
+            logging.error(f"Criminal IP credits exhausted, stopping collection: {reason}")
+        self.exhausted = True
+
+    def record_new_ip(self, query):
+        """Function to count a new IP against the query that found it"""
+        with self._lock:
+            self.run_new_ips[self._key(query)] += 1
+
+    def query_yield(self, query):
+        """Function to return the historical new IPs per credit of a query"""
+        stats = self.history.get(self._key(query))
+        if not stats or not stats.get("credits"):
+            return DEFAULT_QUERY_YIELD
+        return stats["new_ips"] / stats["credits"]
+
+    def plan(self, query_counts):
+        """Function to give the remaining credits to the highest-yield queries first"""
+        self.counts.update(query_counts)
+        remaining = self.remaining()
+        ranked = sorted(query_counts, key=self.query_yield, reverse=True)
+        for query in ranked:
+            pages = pages_for_count(query_counts[query])
+            # The first page came with the count and is already paid for
+            paid_for = min(pages, 1) if query in self.first_pages else 0
+            if remaining is not None:
+                pages = paid_for + max(0, min(pages - paid_for, remaining // self.credits_per_request))
+                remaining -= (pages - paid_for) * self.credits_per_request
+            self.page_limits[query] = pages
+            logging.info(
+                f"Crawl plan: {query} count {query_counts[query]}, "
+                f"yield {self.query_yield(query):.2f}, pages {pages}"
+            )
+
+    def report(self):
+        """Function to log credits spent per unique new IP and persist the yield history"""
+        total_credits = sum(self.run_credits.values())
+        total_new_ips = sum(self.run_new_ips.values())
+        for query in sorted(self.run_credits, key=self.run_credits.get, reverse=True):
+            credits = self.run_credits[query]
+            new_ips = self.run_new_ips[query]
+            cost = f"{credits / new_ips:.2f}" if new_ips else "n/a"
+            logging.info(
+                f"Credit report: {query} spent {credits}, new IPs {new_ips}, credits per new IP {cost}"
+            )
+            stats = self.history.setdefault(query, {"credits": 0, "new_ips": 0})
+            stats["credits"] += credits
+            stats["new_ips"] += new_ips
+        if self._templates:
+            # Drops entries of queries no longer in the query file, and the old per-date keys
+            templates = set(self._templates.values())
+            self.history = {key: stats for key, stats in self.history.items() if key in templates}
+        run_cost = f"{total_credits / total_new_ips:.2f}" if total_new_ips else "n/a"
+        logging.info(
+            f"Credit report: run spent {total_credits} (today {self.used_today}), "
+            f"new IPs {total_new_ips}, credits per new IP {run_cost}"
+        )
+
+        os.makedirs(os.path.dirname(self.budget_file_name), exist_ok=True)
+        temp_file_name = f"{self.budget_file_name}.tmp"
+        with open(temp_file_name, "w") as budget_file:
+            json.dump(
+                {"date": date, "used_today": self.used_today, "history": self.history},
+                budget_file,
+                indent=4,
+            )
+        os.replace(temp_file_name, self.budget_file_name)
@@ -2,8 +2,24 @@ import requests
 import json
 import logging
 import time
-import csv
-from fire_config import LOG_FILE_NAME, BASE_URL, ENDPOINT, HEADERS, date, ip_data, CSV_FILE_PATH
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from fire_config import (
+    LOG_FILE_NAME,
+    BASE_URL,
+    ENDPOINT,
+    HEADERS,
+    date,
+    ip_data,
+    CIP_QUOTA_STATUS_CODES,
+    CIP_RATE_LIMIT_STATUS_CODES,
+    CIP_RATE_LIMIT_MAX_DELAY_SECONDS,
+    CIP_RATE_LIMIT_RETRY_COUNT,
+    CIP_EXTRA_RESULT_FIELDS,
+)
+from core.api.banner_stream import parse_banner_response, BANNER_FIELDS
+from core.api.watermark import result_identity
+from core.api.budget import pages_for_count
 
 
 # Initialize logger
@@ -19,11 +35,11 @@ RETRY_DELAY_SECONDS = 2
 errcode_list = []
 
 
-def handle_exception(err, err_type, retry_func):
+def handle_exception(err, err_type, retry_func, delay=None):
     """Function for unified error handling"""
     logging.error(f"{err_type}: {err}")
-    time.sleep(RETRY_DELAY_SECONDS)
-    retry_func()
+    time.sleep(RETRY_DELAY_SECONDS if delay is None else delay)
+    return retry_func()
 
 
 def check_payload(now_query, offset):
@@ -31,106 +47,205 @@ def check_payload(now_query, offset):
     return {"query": now_query, "offset": offset}
 
 
-def process_query(url, c2_name, payload, COUNT=0):
-    """Function to collect IP data for the received query"""
-    global MAX_RETRY_COUNT
-    if COUNT >= MAX_RETRY_COUNT:
-        logging.error(
-            "Maximum retry count reached. Please check the server for verification."
-        )
-        process_query(url, c2_name, payload, COUNT + 1)
-    try:
-        response2_json = requests.request("GET", url, headers=HEADERS, params=payload)
+def is_quota_error(err):
+    """Function to check if an HTTP error means the account is out of credits"""
+    response = getattr(err, "response", None)
+    return response is not None and response.status_code in CIP_QUOTA_STATUS_CODES
+
+
+def is_rate_limited(err):
+    """Function to check if an HTTP error is a temporary rate limit"""
+    response = getattr(err, "response", None)
+    return response is not None and response.status_code in CIP_RATE_LIMIT_STATUS_CODES
+
+
+def retry_delay(err, attempt):
+    """Function to return the wait before retrying, honouring Retry-After on rate limits"""
+    if not is_rate_limited(err):
+        return RETRY_DELAY_SECONDS
+    value = err.response.headers.get("Retry-After")
+    if value:
+        try:
+            return min(max(0.0, float(value)), CIP_RATE_LIMIT_MAX_DELAY_SECONDS)
+        except ValueError:
+            pass
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            return min(max(0.0, seconds), CIP_RATE_LIMIT_MAX_DELAY_SECONDS)
+        except (TypeError, ValueError):
+            logging.warning(f"Unexpected Retry-After header value: {value}")
+    return min(RETRY_DELAY_SECONDS * 2 ** attempt, CIP_RATE_LIMIT_MAX_DELAY_SECONDS)
+
+
+def fetch_page(url, payload, budget=None):
+    """Function to request one page of a query and return its status fields and results"""
+    with requests.request(
+        "GET", url, headers=HEADERS, params=payload, stream=True
+    ) as response2_json:
         logging.info(f"check payload:{payload}, response2_json: {response2_json}")
         response2_json.raise_for_status()
+        if budget is not None:
+            budget.charge(payload["query"], response2_json.headers)
+
+        # Only the projected fields of each result are kept, the banners are skipped
+        meta, result = parse_banner_response(
+            response2_json, BANNER_FIELDS + tuple(CIP_EXTRA_RESULT_FIELDS)
+        )
+    logging.info(f"now status:{meta.get('status')}")
+    assert meta.get("status") == 200
+    return meta, result
 
-        data = response2_json.json()
-        logging.info(f"now status:{data['status']}")
-        assert data["status"] == 200
-        result = data["data"]["result"]
 
-        for item in result:
-            ip_address = item["ip_address"]
-            logging.info([str(date), ip_address])
+def collect_new_ips(c2_name, query, result, on_new_ip=None):
+    """Function to hand the IPs of a page that were not seen earlier in the run to on_new_ip"""
+    for item in result:
+        ip_address = item["ip_address"]
+        logging.info([str(date), ip_address])
 
-            if ip_address not in ip_data:
-                with open(CSV_FILE_PATH, "a", newline="") as file:
-                    writer = csv.writer(file)
-                    if not ip_data:
-                        writer.writerow(["Date", "IP Address"])
+        # New IPs are written once, to the optional audit file, after the run
+        if ip_address not in ip_data:
+            ip_data.add(ip_address)
+            if on_new_ip is not None:
+                item["query"] = query
+                on_new_ip(c2_name, item)
 
-                    writer.writerow([str(date), ip_address])
+    logging.info(f"Number of deduplicated IPs: {len(ip_data)}")
+    return result
 
-                ip_data.add(ip_address)
 
-        logging.info(f"Number of deduplicated IPs: {len(ip_data)}")
+def process_query(url, c2_name, payload, COUNT=0, on_new_ip=None, budget=None):
+    """Function to collect IP data for the received query and return the page's results"""
+    global MAX_RETRY_COUNT
+    if COUNT >= MAX_RETRY_COUNT:
+        logging.error(
+            "Maximum retry count reached. Please check the server for verification."
+        )
+        return None
+    if budget is not None and not budget.can_spend():
+        logging.error(f"No Criminal IP credits left, skipping payload:{payload}")
+        return None
+    try:
+        meta, result = fetch_page(url, payload, budget)
+        return collect_new_ips(c2_name, payload["query"], result, on_new_ip)
 
     except json.JSONDecodeError as json_err:
-        handle_exception(
+        return handle_exception(
             json_err,
             "JSONDecodeError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
         )
     except requests.exceptions.HTTPError as err:
-        handle_exception(
-            err, "HTTPError", lambda: process_query(url, c2_name, payload, COUNT + 1)
+        # Retrying cannot succeed once the quota is used up
+        if is_quota_error(err):
+            logging.error(f"HTTPError: {err}")
+            if budget is not None:
+                budget.mark_exhausted(err)
+            return None
+        return handle_exception(
+            err,
+            "HTTPError",
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
+            retry_delay(err, COUNT),
         )
     except requests.exceptions.ChunkedEncodingError as chunked_err:
-        handle_exception(
+        return handle_exception(
             chunked_err,
             "ChunkedEncodingError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
         )
     except requests.exceptions.ConnectionError as connect_err:
-        handle_exception(
+        return handle_exception(
             connect_err,
             "ConnectionError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
         )
     except requests.exceptions.RequestException as e:
-        handle_exception(
+        return handle_exception(
             e,
             "RequestException",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
         )
     except AssertionError as err:
-        handle_exception(
+        return handle_exception(
             err,
             "AssertionError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
+            lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget),
         )
     except Exception as err:
-        handle_exception(
-            err, "Exception", lambda: process_query(url, c2_name, payload, COUNT + 1)
+        return handle_exception(
+            err, "Exception", lambda: process_query(url, c2_name, payload, COUNT + 1, on_new_ip, budget)
         )
 
 
-def process_ioc(c2_name, query_list):
+def fetch_first_page(now_query, budget=None):
+    """Function to request the first page of a query, returning its total result count and results"""
+    meta, result = fetch_page(BASE_URL+ENDPOINT, check_payload(now_query, 0), budget)
+    fetched_at = datetime.now(timezone.utc)
+    for item in result:
+        item["fetched_at"] = fetched_at
+    logging.info("result total_count: %d", meta["count"])
+    return meta["count"], result
+
+
+def plan_query_budget(query_items, budget):
+    """Function to read every query's result count and plan the pages each one may spend"""
+    query_counts = {}
+    for c2_name, query_list in query_items:
+        for now_query in query_list:
+            if not budget.can_spend():
+                logging.error("Credit budget used up while planning, remaining queries get no pages.")
+                break
+            for attempt in range(CIP_RATE_LIMIT_RETRY_COUNT):
+                time.sleep(RETRY_DELAY_SECONDS)
+                try:
+                    # The page paid for with the count is kept so collection does not fetch it again
+                    query_counts[now_query], budget.first_pages[now_query] = fetch_first_page(
+                        now_query, budget
+                    )
+                except requests.exceptions.HTTPError as err:
+                    logging.error(f"HTTPError: {err}")
+                    if is_quota_error(err):
+                        budget.mark_exhausted(err)
+                    elif is_rate_limited(err):
+                        time.sleep(retry_delay(err, attempt))
+                        continue
+                except Exception as err:
+                    logging.error(f"Failed to count {c2_name} query {now_query}: {err}")
+                break
+    budget.plan(query_counts)
+
+
+def process_ioc(c2_name, query_list, on_new_ip=None, watermarks=None, budget=None):
     """Function to calculate maximum execution count to check malicious tags"""
     global errcode_list, RETRY_DELAY_SECONDS
     for now_query in query_list:
         offset = 0
+        fetched_at = datetime.now()
+        newest_identity = None
+        truncated = False
+        failed_pages = []
+        attempt = 0
+        first_page = budget.first_pages.pop(now_query, None) if budget is not None else None
         while True:
+            if budget is not None and not budget.can_spend():
+                logging.error(f"No Criminal IP credits left, skipping query: {now_query}")
+                return
             logging.info(f"Processing target C2: {c2_name}, Using query: {now_query}")
 
-            payload = check_payload(now_query, offset)
             time.sleep(RETRY_DELAY_SECONDS)
 
             try:
-                response = requests.get(BASE_URL+ENDPOINT, headers=HEADERS, params=payload)
-                logging.info(
-                    "check query %s/ check offset %d / Current server status response: %s",
-                    now_query,
-                    offset,
-                    response,
-                )
-                response.raise_for_status()
-                data = response.json()
-
-                assert data["status"] == 200
-                logging.info("result total_count: %d", data["data"]["count"])
-
-                total_count = int(data["data"]["count"] / 10) + 1
+                result_count = budget.counts.get(now_query) if budget is not None else None
+                if result_count is None:
+                    result_count, first_page = fetch_first_page(now_query, budget)
+
+                # Same page count the budget plans with, capped at the last offset the API accepts
+                total_count = pages_for_count(result_count)
+                page_limit = budget.page_limits.get(now_query) if budget is not None else None
+                if page_limit is not None and page_limit < total_count:
+                    logging.info(f"Credit plan limits {now_query} to {page_limit} of {total_count} pages")
+                    total_count = page_limit
+                    truncated = True
                 logging.info("count: %d", total_count)
 
                 for count in range(total_count):
@@ -141,14 +256,41 @@ def process_ioc(c2_name, query_list):
                             "Reached maximum offset value and attempting to output the next query."
                         )
                         break
-                    payload = check_payload(now_query, offset)
-                    time.sleep(RETRY_DELAY_SECONDS)
-                    process_query(BASE_URL+ENDPOINT, c2_name, payload)
+                    if offset == 0 and first_page is not None:
+                        results = collect_new_ips(c2_name, now_query, first_page, on_new_ip)
+                    elif budget is not None and not budget.can_spend():
+                        logging.error(f"No Criminal IP credits left, stopping query {now_query} at offset {offset}")
+                        truncated = True
+                        break
+                    else:
+                        payload = check_payload(now_query, offset)
+                        time.sleep(RETRY_DELAY_SECONDS)
+                        results = process_query(
+                            BASE_URL+ENDPOINT, c2_name, payload, on_new_ip=on_new_ip, budget=budget
+                        )
+                    if results is None:
+                        failed_pages.append(offset)
+
+                    if watermarks is not None and results:
+                        if newest_identity is None:
+                            newest_identity = result_identity(results[0])
+                        # Results are newest first, so everything past the last seen one was fetched before
+                        if watermarks.reached(now_query, results):
+                            logging.info(
+                                f"Reached the previous watermark of {now_query} at offset {offset}"
+                            )
+                            break
 
             except json.JSONDecodeError as json_err:
                 handle_exception(json_err, "JSONDecodeError", lambda: None)
             except requests.exceptions.HTTPError as err:
-                handle_exception(err, "HTTPError", lambda: None)
+                if is_quota_error(err):
+                    logging.error(f"HTTPError: {err}")
+                    if budget is not None:
+                        budget.mark_exhausted(err)
+                    return
+                handle_exception(err, "HTTPError", lambda: None, retry_delay(err, attempt))
+                attempt += 1
             except requests.exceptions.ChunkedEncodingError as chunked_err:
                 handle_exception(chunked_err, "ChunkedEncodingError", lambda: None)
             except requests.exceptions.ConnectionError as connect_err:
@@ -160,4 +302,9 @@ def process_ioc(c2_name, query_list):
             except Exception as err:
                 handle_exception(err, "Exception", lambda: None)
             else:
+                # A query cut short by the budget or a failed page keeps its old mark so the missed pages are read next time
+                if failed_pages:
+                    logging.error(f"Pages of {now_query} failed at offsets {failed_pages}, watermark kept")
+                elif watermarks is not None and not truncated:
+                    watermarks.stage(now_query, newest_identity, fetched_at)
                 break
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+from fire_config import LOG_FILE_NAME, WATERMARK_FILE_PATH
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+
+def result_identity(item):
+    """Function to build the identity of a banner search result"""
+    return f"{item.get('ip_address')}|{item.get('scan_dtime')}"
+
+
+class Watermarks:
+    """Per-query high-water marks of the last successful Criminal IP fetch"""
+
+    def __init__(self, watermark_file_name=WATERMARK_FILE_PATH):
+        self.watermark_file_name = watermark_file_name
+        self.marks = {}
+        self._templates = {}
+        self._staged = {}
+        self._lock = threading.Lock()
+        if os.path.exists(watermark_file_name):
+            try:
+                with open(watermark_file_name, "r") as watermark_file:
+                    self.marks = json.load(watermark_file)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.error(f"Error reading watermarks, fetching full windows: {str(e)}")
+
+    def bind(self, query, template):
+        """Function to remember which query file entry a rendered query came from"""
+        self._templates[query] = template
+
+    def _key(self, query):
+        return self._templates.get(query, query)
+
+    def after_date(self, template, default_date):
+        """Function to return the date to substitute for {% now_date %}"""
+        mark = self.marks.get(template)
+        return mark["after"] if mark else default_date
+
+    def reached(self, query, results):
+        """Function to check if a page contains the last result seen by the previous run"""
+        mark = self.marks.get(self._key(query))
+        if not mark or not mark.get("last_seen"):
+            return False
+        return any(result_identity(item) == mark["last_seen"] for item in results)
+
+    def stage(self, query, last_seen, fetched_at):
+        """Function to record a completed query, written out on commit()"""
+        key = self._key(query)
+        if last_seen is None:
+            last_seen = self.marks.get(key, {}).get("last_seen")
+        with self._lock:
+            self._staged[key] = {
+                "fetched_at": fetched_at.strftime("%Y-%m-%d %H:%M:%S"),
+                # Same one-day look-back the query file uses relative to the run date
+                "after": (fetched_at - timedelta(days=1)).strftime("%Y-%m-%d"),
+                "last_seen": last_seen,
+            }
+
+    def discard(self, query):
+        """Function to keep a query's previous mark, e.g. when some of its IPs were not blocked"""
+        with self._lock:
+            if self._staged.pop(self._key(query), None) is not None:
+                logging.info(f"Watermark of {query} kept so its results are fetched again")
+
+    def commit(self):
+        """Function to atomically persist the marks of the queries completed in this run"""
+        with self._lock:
+            if not self._staged:
+                return
+            marks = dict(self.marks)
+            marks.update(self._staged)
+            os.makedirs(os.path.dirname(self.watermark_file_name), exist_ok=True)
+            temp_file_name = f"{self.watermark_file_name}.tmp"
+            with open(temp_file_name, "w") as watermark_file:
+                json.dump(marks, watermark_file, indent=4)
+                watermark_file.flush()
+                os.fsync(watermark_file.fileno())
+            os.replace(temp_file_name, self.watermark_file_name)
+            self.marks = marks
+            logging.info(f"Watermarks updated for {len(self._staged)} queries")
+            self._staged = {}
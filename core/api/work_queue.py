@@ -0,0 +1,558 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+from fire_config import (
+    LOG_FILE_NAME,
+    BASE_URL,
+    ENDPOINT,
+    WORK_QUEUE_BACKEND,
+    WORK_QUEUE_DB_PATH,
+    WORK_QUEUE_DIR,
+    WORK_UNIT_PAGES,
+    WORK_LEASE_SECONDS,
+    WORK_POLL_SECONDS,
+    WORK_MAX_ATTEMPTS,
+    WORK_RUN_WAIT_SECONDS,
+    ip_data,
+)
+from core.api.cip_request_get_ip import check_payload, process_query, RETRY_DELAY_SECONDS
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    c2_name TEXT NOT NULL,
+    query TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    offset_start INTEGER NOT NULL,
+    offset_end INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS units_claim ON units (status, priority, id);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL,
+    unit_id INTEGER NOT NULL,
+    c2_name TEXT NOT NULL,
+    query TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    ip_address TEXT NOT NULL,
+    scan_dtime TEXT,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (run_id, unit_id, ip_address)
+);
+"""
+
+
+def default_worker_id():
+    """Function to build a worker id that is unique across hosts and processes"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """SQLite-backed queue of (query, offset range) work units claimed with leases"""
+
+    def __init__(self, db_path=WORK_QUEUE_DB_PATH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Autocommit mode; multi-statement changes use explicit BEGIN IMMEDIATE transactions
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def start_run(self, run_id):
+        """Function to register a run that is still being planned, so workers wait for its units"""
+        self._conn.execute("INSERT OR REPLACE INTO runs (run_id, state) VALUES (?, 'planning')", (run_id,))
+
+    def queue_run(self, run_id):
+        """Function to mark a run as fully queued"""
+        self._conn.execute("UPDATE runs SET state = 'queued' WHERE run_id = ?", (run_id,))
+
+    def runs(self):
+        """Function to return the state of every registered run"""
+        return dict(self._conn.execute("SELECT run_id, state FROM runs").fetchall())
+
+    def enqueue(self, run_id, c2_name, query, priority, pages, pages_per_unit=WORK_UNIT_PAGES, start_page=0):
+        """Function to split a query's pages from start_page on into work units"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            for first_page in range(start_page, pages, pages_per_unit):
+                last_page = min(first_page + pages_per_unit, pages)
+                self._conn.execute(
+                    "INSERT INTO units (run_id, c2_name, query, priority, offset_start, offset_end)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, c2_name, query, priority, first_page * 10, last_page * 10),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, worker_id):
+        """Function to lease the next pending or expired unit, most severe first"""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT id, run_id, c2_name, query, priority, offset_start, offset_end FROM units"
+                " WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?)"
+                " ORDER BY priority, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE units SET status = 'leased', owner = ?, lease_until = ?,"
+                    " attempts = attempts + 1 WHERE id = ?",
+                    (worker_id, now + WORK_LEASE_SECONDS, row[0]),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        keys = ("id", "run_id", "c2_name", "query", "priority", "offset_start", "offset_end")
+        return dict(zip(keys, row))
+
+    def renew(self, unit, worker_id):
+        """Function to extend a lease, returning False if another worker took the unit over"""
+        cursor = self._conn.execute(
+            "UPDATE units SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+            (time.time() + WORK_LEASE_SECONDS, unit["id"], worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, unit, worker_id, items):
+        """Function to store a unit's partial results and mark it done while the lease is held"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self._conn.execute(
+                "UPDATE units SET status = 'done', lease_until = NULL"
+                " WHERE id = ? AND owner = ? AND status = 'leased'",
+                (unit["id"], worker_id),
+            )
+            if cursor.rowcount != 1:
+                self._conn.execute("ROLLBACK")
+                logging.error(f"Lease on work unit {unit['id']} was lost, discarding its results")
+                return False
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO results (run_id, unit_id, c2_name, query, priority,"
+                " ip_address, scan_dtime, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        unit["run_id"],
+                        unit["id"],
+                        unit["c2_name"],
+                        unit["query"],
+                        unit["priority"],
+                        item["ip_address"],
+                        item.get("scan_dtime"),
+                        item["fetched_at"],
+                    )
+                    for item in items
+                ],
+            )
+            self._conn.execute("COMMIT")
+            return True
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def add_results(self, run_id, c2_name, query, priority, items):
+        """Function to store results fetched outside a work unit, such as the page read while planning"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO results (run_id, unit_id, c2_name, query, priority,"
+                " ip_address, scan_dtime, fetched_at) VALUES (?, 0, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        c2_name,
+                        query,
+                        priority,
+                        item["ip_address"],
+                        item.get("scan_dtime"),
+                        item["fetched_at"].isoformat(),
+                    )
+                    for item in items
+                ],
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def release(self, unit, worker_id):
+        """Function to hand a failed unit back to the queue, giving up after WORK_MAX_ATTEMPTS claims"""
+        self._conn.execute(
+            "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " owner = NULL, lease_until = NULL WHERE id = ? AND owner = ? AND status = 'leased'",
+            (WORK_MAX_ATTEMPTS, unit["id"], worker_id),
+        )
+        row = self._conn.execute("SELECT status FROM units WHERE id = ?", (unit["id"],)).fetchone()
+        if row is not None and row[0] == "failed":
+            logging.error(
+                f"Work unit {unit['id']} ({unit['query']} offsets {unit['offset_start']}-{unit['offset_end']})"
+                f" failed {WORK_MAX_ATTEMPTS} times, giving up"
+            )
+
+    def open_units(self, run_id=None):
+        """Function to count units that are still pending or leased"""
+        if run_id is None:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased')"
+            ).fetchone()
+        else:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased') AND run_id = ?",
+                (run_id,),
+            ).fetchone()
+        return row[0]
+
+    def merged_results(self, run_id):
+        """Function to return a run's IPs deduplicated across units, keeping the most severe category"""
+        rows = self._conn.execute(
+            "SELECT ip_address, c2_name, query, priority, scan_dtime, fetched_at"
+            " FROM results WHERE run_id = ? ORDER BY priority, rowid",
+            (run_id,),
+        )
+        keys = ("ip_address", "c2_name", "query", "priority", "scan_dtime", "fetched_at")
+        merged = {}
+        for row in rows:
+            merged.setdefault(row[0], dict(zip(keys, row)))
+        return list(merged.values())
+
+    def purge(self, run_id=None):
+        """Function to drop a merged run's units and partial results, or those of every run"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        if run_id is None:
+            self._conn.execute("DELETE FROM results")
+            self._conn.execute("DELETE FROM units")
+            self._conn.execute("DELETE FROM runs")
+        else:
+            self._conn.execute("DELETE FROM results WHERE run_id = ?", (run_id,))
+            self._conn.execute("DELETE FROM units WHERE run_id = ?", (run_id,))
+            self._conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        self._conn.execute("COMMIT")
+
+
+class DirectoryWorkQueue:
+    """Work queue kept as files in a directory that workers on several hosts share over NFS/SMB
+
+    Each change is one atomic file operation: a claim is an exclusive create, a unit's results
+    appear through a hard link that fails once another worker completed it, and other files are
+    written under a temporary name and renamed into place. Leases compare wall clocks, so the
+    hosts must keep their clocks in sync.
+    """
+
+    def __init__(self, root=WORK_QUEUE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._units = {}
+
+    def close(self):
+        pass
+
+    def _path(self, run_id, kind, name=None):
+        folder = os.path.join(self.root, run_id, kind)
+        return folder if name is None else os.path.join(folder, name)
+
+    def _write(self, path, data):
+        temp_file_name = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_file_name, "w") as temp_file:
+            json.dump(data, temp_file)
+        os.replace(temp_file_name, path)
+        return path
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # A claim is readable only once its creator has written it
+            return None
+
+    def _names(self, folder):
+        try:
+            return sorted(name[: -len(".json")] for name in os.listdir(folder) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _runs(self, run_id=None):
+        if run_id is not None:
+            return [run_id]
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def _unit(self, run_id, unit_id):
+        key = (run_id, unit_id)
+        if key not in self._units:
+            self._units[key] = self._read(self._path(run_id, "units", f"{unit_id}.json"))
+        return self._units[key]
+
+    def _open_units(self, run_id):
+        finished = set(self._names(self._path(run_id, "results"))) | set(self._names(self._path(run_id, "failed")))
+        return [unit_id for unit_id in self._names(self._path(run_id, "units")) if unit_id not in finished]
+
+    def _latest_claims(self, run_id):
+        latest = {}
+        for name in self._names(self._path(run_id, "claims")):
+            unit_id, attempt = name.rsplit(".", 1)
+            latest[unit_id] = max(latest.get(unit_id, 0), int(attempt))
+        return latest
+
+    def _claim_path(self, unit):
+        return self._path(unit["run_id"], "claims", f"{unit['id']}.{unit['attempt']}.json")
+
+    def _holds(self, unit, worker_id):
+        if self._latest_claims(unit["run_id"]).get(unit["id"]) != unit["attempt"]:
+            return False
+        claim = self._read(self._claim_path(unit))
+        return claim is not None and claim["owner"] == worker_id and not claim.get("released")
+
+    def start_run(self, run_id):
+        """Function to register a run that is still being planned, so workers wait for its units"""
+        for kind in ("units", "claims", "results", "failed"):
+            os.makedirs(self._path(run_id, kind), exist_ok=True)
+        self._write(os.path.join(self.root, run_id, "run.json"), {"state": "planning"})
+
+    def queue_run(self, run_id):
+        """Function to mark a run as fully queued"""
+        self._write(os.path.join(self.root, run_id, "run.json"), {"state": "queued"})
+
+    def runs(self):
+        """Function to return the state of every registered run"""
+        states = {}
+        for run_id in self._runs():
+            run = self._read(os.path.join(self.root, run_id, "run.json"))
+            if run is not None:
+                states[run_id] = run["state"]
+        return states
+
+    def enqueue(self, run_id, c2_name, query, priority, pages, pages_per_unit=WORK_UNIT_PAGES, start_page=0):
+        """Function to split a query's pages from start_page on into work units"""
+        sequence = len(self._names(self._path(run_id, "units")))
+        for first_page in range(start_page, pages, pages_per_unit):
+            last_page = min(first_page + pages_per_unit, pages)
+            self._write(
+                self._path(run_id, "units", f"{sequence:06d}.json"),
+                {
+                    "c2_name": c2_name,
+                    "query": query,
+                    "priority": priority,
+                    "offset_start": first_page * 10,
+                    "offset_end": last_page * 10,
+                },
+            )
+            sequence += 1
+
+    def claim(self, worker_id):
+        """Function to lease the next pending or expired unit, most severe first"""
+        now = time.time()
+        candidates = []
+        for run_id in self._runs():
+            latest = self._latest_claims(run_id)
+            for unit_id in self._open_units(run_id):
+                spec = self._unit(run_id, unit_id)
+                if spec is not None:
+                    candidates.append((spec["priority"], run_id, unit_id, latest.get(unit_id, 0)))
+
+        for _, run_id, unit_id, attempt in sorted(candidates):
+            if attempt:
+                claim = self._read(self._path(run_id, "claims", f"{unit_id}.{attempt}.json"))
+                if claim is None or (not claim.get("released") and claim["lease_until"] >= now):
+                    continue
+            unit = dict(self._unit(run_id, unit_id), id=unit_id, run_id=run_id, attempt=attempt + 1)
+            try:
+                # Of the workers racing for the same unit only one creates the next claim
+                fd = os.open(self._claim_path(unit), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as claim_file:
+                json.dump({"owner": worker_id, "lease_until": now + WORK_LEASE_SECONDS}, claim_file)
+            if os.path.exists(self._path(run_id, "results", f"{unit_id}.json")):
+                # Completed by its previous owner after the listing above
+                continue
+            return unit
+        return None
+
+    def renew(self, unit, worker_id):
+        """Function to extend a lease, returning False if another worker took the unit over"""
+        if not self._holds(unit, worker_id):
+            return False
+        self._write(
+            self._claim_path(unit), {"owner": worker_id, "lease_until": time.time() + WORK_LEASE_SECONDS}
+        )
+        return True
+
+    def complete(self, unit, worker_id, items):
+        """Function to store a unit's partial results and mark it done while the lease is held"""
+        results_path = self._path(unit["run_id"], "results", f"{unit['id']}.json")
+        if self._holds(unit, worker_id):
+            temp_file_name = self._write(
+                f"{results_path}.{uuid.uuid4().hex}",
+                [
+                    {
+                        "ip_address": item["ip_address"],
+                        "c2_name": unit["c2_name"],
+                        "query": unit["query"],
+                        "priority": unit["priority"],
+                        "scan_dtime": item.get("scan_dtime"),
+                        "fetched_at": item["fetched_at"],
+                    }
+                    for item in items
+                ],
+            )
+            try:
+                os.link(temp_file_name, results_path)
+                return True
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_file_name)
+        logging.error(f"Lease on work unit {unit['id']} was lost, discarding its results")
+        return False
+
+    def add_results(self, run_id, c2_name, query, priority, items):
+        """Function to store results fetched outside a work unit, such as the page read while planning"""
+        os.makedirs(self._path(run_id, "results"), exist_ok=True)
+        self._write(
+            self._path(run_id, "results", f"first-{uuid.uuid4().hex}.json"),
+            [
+                {
+                    "ip_address": item["ip_address"],
+                    "c2_name": c2_name,
+                    "query": query,
+                    "priority": priority,
+                    "scan_dtime": item.get("scan_dtime"),
+                    "fetched_at": item["fetched_at"].isoformat(),
+                }
+                for item in items
+            ],
+        )
+
+    def release(self, unit, worker_id):
+        """Function to hand a failed unit back to the queue, giving up after WORK_MAX_ATTEMPTS claims"""
+        if not self._holds(unit, worker_id):
+            return
+        if unit["attempt"] >= WORK_MAX_ATTEMPTS:
+            self._write(self._path(unit["run_id"], "failed", f"{unit['id']}.json"), {"owner": worker_id})
+            logging.error(
+                f"Work unit {unit['id']} ({unit['query']} offsets {unit['offset_start']}-{unit['offset_end']})"
+                f" failed {WORK_MAX_ATTEMPTS} times, giving up"
+            )
+        self._write(self._claim_path(unit), {"owner": worker_id, "lease_until": 0, "released": True})
+
+    def open_units(self, run_id=None):
+        """Function to count units that are still pending or leased"""
+        return sum(len(self._open_units(run)) for run in self._runs(run_id))
+
+    def merged_results(self, run_id):
+        """Function to return a run's IPs deduplicated across units, keeping the most severe category"""
+        rows = []
+        for name in self._names(self._path(run_id, "results")):
+            rows.extend(self._read(self._path(run_id, "results", f"{name}.json")) or [])
+        merged = {}
+        for row in sorted(rows, key=lambda row: row["priority"]):
+            merged.setdefault(row["ip_address"], row)
+        return list(merged.values())
+
+    def purge(self, run_id=None):
+        """Function to drop a merged run's units and partial results, or those of every run"""
+        for run in self._runs(run_id):
+            shutil.rmtree(os.path.join(self.root, run), ignore_errors=True)
+        self._units.clear()
+
+
+def open_work_queue():
+    """Function to open the work queue backend selected by WORK_QUEUE_BACKEND"""
+    if WORK_QUEUE_BACKEND == "directory":
+        return DirectoryWorkQueue()
+    return WorkQueue()
+
+
+def fetch_work_unit(unit, work_queue, worker_id, items):
+    """Function to fetch every page of a work unit into items, returning False if a page failed or the lease was lost"""
+
+    def collect(c2_name, item):
+        item["fetched_at"] = datetime.now(timezone.utc).isoformat()
+        items.append(item)
+
+    for offset in range(unit["offset_start"], unit["offset_end"], 10):
+        payload = check_payload(unit["query"], offset)
+        time.sleep(RETRY_DELAY_SECONDS)
+        results = process_query(BASE_URL+ENDPOINT, unit["c2_name"], payload, on_new_ip=collect)
+        if results is None:
+            logging.error(f"Work unit {unit['id']} failed at offset {offset}, handing it back")
+            work_queue.release(unit, worker_id)
+            return False
+        if not work_queue.renew(unit, worker_id):
+            return False
+    return True
+
+
+def run_worker(work_queue, worker_id=None, run_id=None):
+    """Function to claim and fetch work units until the run is finished
+
+    The coordinator passes its run_id and stops once none of that run's units is open. A worker
+    started on its own waits for a coordinator to register a run, and stops once every registered
+    run is queued and has no open unit left, or after WORK_RUN_WAIT_SECONDS without any.
+    """
+    worker_id = worker_id or default_worker_id()
+    completed = 0
+    idle_since = time.monotonic()
+    while True:
+        unit = work_queue.claim(worker_id)
+        if unit is None:
+            # Leased units may still come back if their worker dies
+            if work_queue.open_units(run_id):
+                idle_since = time.monotonic()
+            elif run_id is not None:
+                break
+            else:
+                runs = work_queue.runs()
+                if runs and "planning" not in runs.values():
+                    break
+                if time.monotonic() - idle_since > WORK_RUN_WAIT_SECONDS:
+                    logging.error(f"Worker {worker_id} found no queued run for {WORK_RUN_WAIT_SECONDS} seconds, stopping")
+                    break
+            time.sleep(WORK_POLL_SECONDS)
+            continue
+
+        logging.info(
+            f"Worker {worker_id} fetching {unit['query']} offsets {unit['offset_start']}-{unit['offset_end']}"
+        )
+        items = []
+        try:
+            fetched = fetch_work_unit(unit, work_queue, worker_id, items)
+        except Exception as err:
+            logging.error(f"Worker {worker_id} failed on work unit {unit['id']}: {err}")
+            work_queue.release(unit, worker_id)
+            fetched = False
+        if fetched and work_queue.complete(unit, worker_id, items):
+            completed += 1
+        else:
+            # Forget the discarded IPs so a retry of the unit in this process reports them again
+            ip_data.difference_update(item["ip_address"] for item in items)
+
+    logging.info(f"Worker {worker_id} finished after {completed} work units")
+    return completed
@@ -0,0 +1,114 @@
+import csv
+import logging
+import math
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from fire_config import LOG_FILE_NAME, FRESHNESS_FILE_NAME, CIP_TIMESTAMP_UTC_OFFSET_HOURS
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+FRESHNESS_CSV_FORMAT = ["IP Address", "Category", "Detected", "Fetched", "Enforced"]
+CIP_TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f")
+CIP_TIMEZONE = timezone(timedelta(hours=CIP_TIMESTAMP_UTC_OFFSET_HOURS))
+
+
+def utc_now():
+    """Function to return the current time as an aware UTC datetime"""
+    return datetime.now(timezone.utc)
+
+
+def parse_cip_timestamp(value):
+    """Function to parse the scan time of a Criminal IP result, or return None"""
+    if not value:
+        return None
+    for time_format in CIP_TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=CIP_TIMEZONE).astimezone(timezone.utc)
+    return None
+
+
+def percentile(sorted_values, fraction):
+    """Function to return the nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class FreshnessTracker:
+    """Per-IP detection, fetch and enforcement times with time-to-block percentiles"""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def enforced(self, records, enforced_at=None):
+        """Function to record the time the given IPs became effective on the firewall"""
+        enforced_at = enforced_at or utc_now()
+        with self._lock:
+            for record in records:
+                self.records.append(
+                    {
+                        "ip_address": record["ip_address"],
+                        "category": record["category"],
+                        "detected_at": parse_cip_timestamp(record.get("detected_at")),
+                        "fetched_at": record.get("fetched_at"),
+                        "enforced_at": enforced_at,
+                    }
+                )
+
+    def summarize(self):
+        """Function to compute p50/p95/max time-to-block in seconds, per run and per category"""
+        groups = {"all": []}
+        for record in self.records:
+            if record["detected_at"] is None:
+                continue
+            seconds = (record["enforced_at"] - record["detected_at"]).total_seconds()
+            groups["all"].append(seconds)
+            groups.setdefault(record["category"], []).append(seconds)
+
+        summary = {}
+        for name, values in groups.items():
+            values.sort()
+            summary[name] = {
+                "count": len(values),
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "max": values[-1] if values else None,
+            }
+        return summary
+
+    def report(self, freshness_file_name=FRESHNESS_FILE_NAME):
+        """Function to write the per-IP times and log the freshness percentiles"""
+        write_header = not os.path.exists(freshness_file_name)
+        with open(freshness_file_name, "a", newline="") as freshness_file:
+            writer = csv.writer(freshness_file)
+            if write_header:
+                writer.writerow(FRESHNESS_CSV_FORMAT)
+            for record in self.records:
+                writer.writerow(
+                    [
+                        record["ip_address"],
+                        record["category"],
+                        record["detected_at"].isoformat() if record["detected_at"] else "",
+                        record["fetched_at"].isoformat() if record["fetched_at"] else "",
+                        record["enforced_at"].isoformat(),
+                    ]
+                )
+
+        for name, stats in self.summarize().items():
+            if not stats["count"]:
+                logging.info(f"Time-to-block [{name}]: no IPs with a detection time")
+                continue
+            logging.info(
+                f"Time-to-block [{name}]: {stats['count']} IPs, p50 {stats['p50']:.0f}s, "
+                f"p95 {stats['p95']:.0f}s, max {stats['max']:.0f}s"
+            )
@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from fire_config import (
+    LOG_FILE_NAME,
+    BLOCKED_IP_FILTER_PATH,
+    BLOCKED_IP_FILTER_CAPACITY,
+    BLOCKED_IP_FILTER_ERROR_RATE,
+)
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+_MAGIC = b"CIPBLM02"
+_OLD_MAGICS = (b"CIPBLM01",)
+# magic, number of bits, number of hash functions, capacity, addresses inserted
+_HEADER = struct.Struct("<8sQIQQ")
+_INSERTED_OFFSET = _HEADER.size - 8
+
+
+class BlockedIPFilter:
+    """Memory-mapped Bloom filter of every IP address that has been blocked on the firewall"""
+
+    def __init__(
+        self,
+        path=BLOCKED_IP_FILTER_PATH,
+        capacity=BLOCKED_IP_FILTER_CAPACITY,
+        error_rate=BLOCKED_IP_FILTER_ERROR_RATE,
+    ):
+        self.path = path
+        self.capacity = capacity
+        # A rebuild uses the configured size, which may differ from the size stored in the file
+        self._configured = (capacity, error_rate)
+        self._lock = threading.Lock()
+        self.created = not os.path.exists(path)
+        if self.created:
+            self._create(path, capacity, error_rate)
+        self._open()
+        if self._magic in _OLD_MAGICS:
+            logging.info(f"Blocked IP filter {path} has an old format, rebuilding it")
+            self.reset()
+        elif self._magic != _MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a blocked IP filter file")
+        logging.info(
+            f"Blocked IP filter loaded from {path} ({self.bit_count} bits, {self.hash_count} hashes, "
+            f"{self.inserted} of {self.capacity} addresses)"
+        )
+
+    def _open(self):
+        self._file = open(self.path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._magic = bytes(self._map[:8])
+        if self._magic == _MAGIC:
+            _, self.bit_count, self.hash_count, self.capacity, self.inserted = _HEADER.unpack_from(
+                self._map, 0
+            )
+
+    @staticmethod
+    def _create(path, capacity, error_rate):
+        bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as filter_file:
+            filter_file.write(_HEADER.pack(_MAGIC, bit_count, hash_count, capacity, 0))
+            # Extend with zeros; the file stays sparse until bits are set
+            filter_file.truncate(_HEADER.size + (bit_count + 7) // 8)
+        logging.info(f"Blocked IP filter {path} created for {capacity} addresses")
+
+    def _positions(self, ip_address):
+        digest = hashlib.blake2b(ip_address.encode(), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, ip_address):
+        """Function to record an IP address as blocked"""
+        with self._lock:
+            new_bits = False
+            for position in self._positions(ip_address):
+                offset = _HEADER.size + (position >> 3)
+                bit = 1 << (position & 7)
+                if not self._map[offset] & bit:
+                    self._map[offset] |= bit
+                    new_bits = True
+            # Only addresses that set a new bit count, so re-adding a blocked IP does not fill the filter
+            if new_bits:
+                self.inserted += 1
+                struct.pack_into("<Q", self._map, _INSERTED_OFFSET, self.inserted)
+
+    @property
+    def full(self):
+        """True once more addresses were added than the filter was sized for"""
+        return self.inserted >= self.capacity
+
+    def reset(self):
+        """Function to replace the filter with an empty one of the configured size"""
+        self.close()
+        os.remove(self.path)
+        self._create(self.path, *self._configured)
+        self._open()
+        self.created = True
+
+    def __contains__(self, ip_address):
+        for position in self._positions(ip_address):
+            if not self._map[_HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def close(self):
+        """Function to flush the filter to disk and release the mapping"""
+        if not self._map.closed:
+            self._map.flush()
+            self._map.close()
+        self._file.close()
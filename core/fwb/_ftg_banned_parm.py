@@ -0,0 +1,54 @@
+import requests
+import json
+import urllib3
+import logging
+from fire_config import LOG_FILE_NAME
+
+# Disable SSL warnings at the beginning of your script
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+
+def get_banned_ip_addresses(ftg_monitor_url, ftg_header):
+    """API call to retrieve the IP addresses currently in the banned user list"""
+    banned_url = ftg_monitor_url + "/user/banned"
+
+    response = requests.get(banned_url, headers=ftg_header, verify=False)
+
+    if response.status_code == 200:
+        results = response.json().get("results", [])
+        banned_ips = {item["ip_address"] for item in results if "ip_address" in item}
+        logging.info(f"Banned user list holds {len(banned_ips)} IPs")
+        return banned_ips
+
+    else:
+        logging.error(
+            f"Failed to retrieve banned users, reason: {response.text} /  Response code: {response.status_code}"
+        )
+        return None
+
+
+def ban_ip_addresses(ip_addresses, expiry_seconds, ftg_monitor_url, ftg_header):
+    """API call to quarantine IP addresses with an expiry"""
+    add_banned_url = ftg_monitor_url + "/user/banned/add_users"
+    payload = {"ip_addresses": list(ip_addresses), "expiry": expiry_seconds}
+
+    response = requests.post(
+        add_banned_url, headers=ftg_header, data=json.dumps(payload), verify=False
+    )
+
+    if response.status_code == 200:
+        logging.info(f"{len(payload['ip_addresses'])} IPs banned for {expiry_seconds} seconds")
+        return True
+
+    else:
+        logging.error(
+            f"Failed to ban IPs, reason: {response.text} /  Response code: {response.status_code}"
+        )
+        return False
+
@@ -0,0 +1,105 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fire_config import (
+    LOG_FILE_NAME,
+    EXPIRY_MAX_WORKERS,
+    EXPIRY_RETRY_COUNT,
+    EXPIRY_RETRY_DELAY_SECONDS,
+)
+from core.fwb._ftg_request_parm import (
+    check_get_group_members_info,
+    delete_groups_in_policy,
+    delete_address_group,
+    delete_address_object,
+)
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+
+def run_with_retry(func, items, max_workers=EXPIRY_MAX_WORKERS, retry_count=EXPIRY_RETRY_COUNT):
+    """Function to run a firewall call concurrently for each item, retrying only the failures"""
+    pending = list(items)
+    succeeded = []
+    for attempt in range(retry_count):
+        if not pending:
+            break
+        if attempt:
+            logging.info(f"Retrying {len(pending)} failed calls (attempt {attempt + 1})")
+            time.sleep(EXPIRY_RETRY_DELAY_SECONDS)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_call_safely(func), pending))
+
+        succeeded.extend(item for item, ok in zip(pending, results) if ok)
+        pending = [item for item, ok in zip(pending, results) if not ok]
+
+    return succeeded, pending
+
+
+def _call_safely(func):
+    def wrapper(item):
+        try:
+            return func(item)
+        except Exception as err:
+            logging.error(f"Firewall call failed for {item}: {err}")
+            return False
+
+    return wrapper
+
+
+def expire_old_groups(policy_id, select_date, ftg_base_url, ftg_header):
+    """Function to remove expired groups from the policy and delete the groups and their members"""
+    summary = {
+        "lookup_failed": False,
+        "groups_found": 0,
+        "groups_deleted": 0,
+        "groups_failed": [],
+        "objects_deleted": 0,
+        "objects_failed": [],
+    }
+
+    expired_groups = check_get_group_members_info(select_date, ftg_base_url, ftg_header)
+    if expired_groups is None:
+        logging.error(f"Unable to look up the groups of {select_date}, nothing was expired")
+        summary["lookup_failed"] = True
+        return summary
+    if not expired_groups:
+        logging.info(f"No expired groups found for {select_date}")
+        return summary
+
+    group_names = [group["name"] for group in expired_groups]
+    summary["groups_found"] = len(group_names)
+
+    # A group still referenced by the policy cannot be deleted, so stop here on failure
+    if not delete_groups_in_policy(policy_id, group_names, ftg_base_url, ftg_header):
+        logging.error("delete_groups_in_policy failed / Unable to delete the groups from the policy.")
+        summary["groups_failed"] = group_names
+        return summary
+
+    deleted_groups, failed_groups = run_with_retry(
+        lambda name: delete_address_group(name, ftg_base_url, ftg_header), group_names
+    )
+    summary["groups_deleted"] = len(deleted_groups)
+    summary["groups_failed"] = failed_groups
+
+    deleted_group_names = set(deleted_groups)
+    members = list(
+        dict.fromkeys(
+            member
+            for group in expired_groups
+            if group["name"] in deleted_group_names
+            for member in group["members"]
+        )
+    )
+    deleted_objects, failed_objects = run_with_retry(
+        lambda name: delete_address_object(name, ftg_base_url, ftg_header), members
+    )
+    summary["objects_deleted"] = len(deleted_objects)
+    summary["objects_failed"] = failed_objects
+
+    return summary
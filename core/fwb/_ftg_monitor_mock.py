@@ -0,0 +1,109 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fire_config import FTG_HEADERS, BANNED_EXPIRY_SECONDS
+from core.fwb._ftg_banned_parm import get_banned_ip_addresses, ban_ip_addresses
+
+MONITOR_PATH = "/api/v2/monitor"
+
+
+class MockBannedUsers:
+    """In-memory banned user list with FortiOS-style expiry"""
+
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def add(self, ip_addresses, expiry_seconds):
+        now = int(time.time())
+        with self._lock:
+            for ip_address in ip_addresses:
+                self.entries[ip_address] = {
+                    "ip_address": ip_address,
+                    "source": "rest_api",
+                    "created": now,
+                    "expires": now + expiry_seconds if expiry_seconds else 0,
+                }
+
+    def list(self):
+        now = int(time.time())
+        with self._lock:
+            return [
+                entry
+                for entry in self.entries.values()
+                if not entry["expires"] or entry["expires"] > now
+            ]
+
+
+def make_handler(banned_users):
+    class MonitorHandler(BaseHTTPRequestHandler):
+        def _reply(self, status_code, body):
+            data = json.dumps(body).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.split("?")[0] != f"{MONITOR_PATH}/user/banned":
+                return self._reply(404, {"status": "error", "http_status": 404})
+            self._reply(200, {"status": "success", "results": banned_users.list()})
+
+        def do_POST(self):
+            if self.path.split("?")[0] != f"{MONITOR_PATH}/user/banned/add_users":
+                return self._reply(404, {"status": "error", "http_status": 404})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                banned_users.add(payload["ip_addresses"], payload.get("expiry", 0))
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400, {"status": "error", "http_status": 400})
+            self._reply(200, {"status": "success"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return MonitorHandler
+
+
+def start_mock_monitor(host="127.0.0.1", port=0):
+    """Function to serve the banned user endpoints in a background thread, returning the server and its monitor URL"""
+    server = ThreadingHTTPServer((host, port), make_handler(MockBannedUsers()))
+    threading.Thread(target=server.serve_forever, name="ftg-monitor-mock", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}{MONITOR_PATH}"
+
+
+def check_banned_backend():
+    """Function to run the banned backend calls against the mock and verify the round trip"""
+    server, monitor_url = start_mock_monitor()
+    try:
+        ips = ["192.0.2.1", "192.0.2.2"]
+        assert get_banned_ip_addresses(monitor_url, FTG_HEADERS) == set()
+        assert ban_ip_addresses(ips, BANNED_EXPIRY_SECONDS, monitor_url, FTG_HEADERS)
+        assert get_banned_ip_addresses(monitor_url, FTG_HEADERS) == set(ips)
+        # Entries drop out of the list once their expiry has passed
+        assert ban_ip_addresses(["192.0.2.3"], -1, monitor_url, FTG_HEADERS)
+        assert get_banned_ip_addresses(monitor_url, FTG_HEADERS) == set(ips)
+        assert get_banned_ip_addresses(monitor_url + "/missing", FTG_HEADERS) is None
+    finally:
+        server.shutdown()
+    print("banned backend check passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the FortiGate banned user monitor API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--check", action="store_true", help="run the banned backend calls against the mock and exit")
+    args = parser.parse_args()
+    if args.check:
+        check_banned_backend()
+    else:
+        server, monitor_url = start_mock_monitor(port=args.port)
+        print(f"Set FTG_MONITOR_URL = \"{monitor_url}\"")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
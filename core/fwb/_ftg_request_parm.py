@@ -4,7 +4,7 @@ import re
 import urllib3
 import logging
 import sys
-from fire_config import LOG_FILE_NAME
+from fire_config import LOG_FILE_NAME, FTG_PAGE_SIZE
 
 # Disable SSL warnings at the beginning of your script
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -16,12 +16,33 @@ logging.basicConfig(
 )
 
 
+def get_paged_results(table_url, ftg_header, params, page_size=FTG_PAGE_SIZE):
+    """API call to read a table page by page with server-side filtering and field selection"""
+    results = []
+    start = 0
+    while True:
+        page_params = dict(params, start=start, count=page_size)
+        response = requests.get(
+            table_url, headers=ftg_header, params=page_params, verify=False
+        )
+        if response.status_code != 200:
+            return None, response
+
+        page = response.json().get("results", [])
+        results.extend(page)
+        if len(page) < page_size:
+            return results, response
+        start += page_size
+
+
 def check_name_exist_address(ipv4address, ftg_base_url, ftg_header):
     """API call to check the existence of an address object"""
     get_addresses_endpoint = f"/address/C2_{ipv4address}"
     get_addresses_url = ftg_base_url + get_addresses_endpoint
 
-    response = requests.get(get_addresses_url, headers=ftg_header, verify=False)
+    response = requests.get(
+        get_addresses_url, headers=ftg_header, params={"format": "name"}, verify=False
+    )
 
     if response.status_code == 200:
         logging.info(f"Address 'C2_{ipv4address}' exists")
@@ -51,26 +72,35 @@ def add_address_object(address_name, ftg_base_url, ftg_header):
 
     if response.status_code == 200:
         logging.info("Address object created successfully")
+        return True
 
     else:
         logging.error(
             f"Failed to create Address object, reason: {response.text} /  Response code: {response.status_code}"
         )
+        return False
 
 
 def delete_address_object(address_name, ftg_base_url, ftg_header):
-    """ """
+    """API call to delete an address object"""
     delete_address_endpoint = f"/address/{address_name}"
     delete_addr_url = ftg_base_url + delete_address_endpoint
     response = requests.delete(delete_addr_url, headers=ftg_header, verify=False)
 
     if response.status_code == 200:
         logging.info("Address object deleted successfully")
+        return True
+
+    # Already gone, e.g. removed by an earlier attempt whose response was lost
+    elif response.status_code == 404:
+        logging.info(f"Address object {address_name} does not exist, nothing to delete")
+        return True
 
     else:
         logging.error(
             f"Failed to delete Address object, reason: {response.text} Response code: {response.status_code}"
         )
+        return False
 
 
 def check_get_group_info(select_date, ftg_base_url, ftg_header):
@@ -79,12 +109,15 @@ def check_get_group_info(select_date, ftg_base_url, ftg_header):
     check_group_endpoint = "/addrgrp"
     check_group_url = ftg_base_url + check_group_endpoint
 
-    response = requests.get(check_group_url, headers=ftg_header, verify=False)
+    data, response = get_paged_results(
+        check_group_url,
+        ftg_header,
+        {"filter": f"name=@C2_{select_date}_", "format": "name"},
+    )
 
-    if response.status_code == 200:
-        logging.info(f"address groups infos {response.text}")
-        data = response.json()["results"]
+    if data is not None:
         matches = [item["name"] for item in data if _pattern.match(item["name"])]
+        logging.info(f"address groups infos {matches}")
         return matches
 
     elif response.status_code == 404:
@@ -104,11 +137,13 @@ def check_get_group_members_info(select_date, ftg_base_url, ftg_header):
     check_group_endpoint = "/addrgrp"
     check_group_url = ftg_base_url + check_group_endpoint
 
-    response = requests.get(check_group_url, headers=ftg_header, verify=False)
+    data, response = get_paged_results(
+        check_group_url,
+        ftg_header,
+        {"filter": f"name=@C2_{select_date}_", "format": "name|member"},
+    )
 
-    if response.status_code == 200:
-        logging.info(f"address groups infos {response.text}")
-        data = response.json()["results"]
+    if data is not None:
         filtered_data = [
             {
                 "name": item["name"],
@@ -135,7 +170,9 @@ def check_address_group_existence(group_name, ftg_base_url, ftg_header):
     check_group_endpoint = f"/addrgrp/{group_name}"
     check_group_url = ftg_base_url + check_group_endpoint
 
-    response = requests.get(check_group_url, headers=ftg_header, verify=False)
+    response = requests.get(
+        check_group_url, headers=ftg_header, params={"format": "name"}, verify=False
+    )
 
     if response.status_code == 200:
         logging.info(f"Address group '{group_name}' exists")
@@ -190,6 +227,10 @@ def delete_address_group(group_name, ftg_base_url, ftg_header):
         logging.info("Address group deleted successfully")
         return True
 
+    elif response.status_code == 404:
+        logging.info(f"Address group {group_name} does not exist, nothing to delete")
+        return True
+
     else:
         logging.error(
             f"Failed to delete Address group, reason: {response.text} /  Response code: {response.status_code}"
@@ -202,7 +243,9 @@ def check_group_in_policy_dstaddr(policy_id, group_name, ftg_base_url, ftg_heade
     check_policy_endpoint = f"/policy/{policy_id}"
     check_policy_url = ftg_base_url + check_policy_endpoint
 
-    response = requests.get(check_policy_url, headers=ftg_header, verify=False)
+    response = requests.get(
+        check_policy_url, headers=ftg_header, params={"format": "dstaddr"}, verify=False
+    )
 
     if response.status_code == 200:
         policy_data = response.json().get("results", [])
@@ -239,7 +282,9 @@ def update_group_in_policy(policy_id, group_name, ftg_base_url, ftg_header):
     policy_url = ftg_base_url + update_policy_endpoint
     new_dstaddr = {"name": f"{group_name}"}
 
-    response = requests.get(policy_url, headers=ftg_header, verify=False)
+    response = requests.get(
+        policy_url, headers=ftg_header, params={"format": "dstaddr"}, verify=False
+    )
 
     if response.status_code == 200:
         policy_data = response.json()["results"][0]
@@ -247,7 +292,10 @@ def update_group_in_policy(policy_id, group_name, ftg_base_url, ftg_header):
             policy_data["dstaddr"].append(new_dstaddr)
             logging.info(policy_data["dstaddr"])
 
-            update_policy(policy_url, ftg_header, policy_data["dstaddr"])
+            return update_policy(policy_url, ftg_header, policy_data["dstaddr"])
+
+        logging.error("Policy has no dstaddr to add the group to")
+        return False
 
     else:
         logging.error(
@@ -263,7 +311,9 @@ def delete_group_in_policy(policy_id, group_name, ftg_base_url, ftg_header):
     policy_url = ftg_base_url + update_policy_endpoint
     delete_dstaddr_name = group_name
 
-    response = requests.get(policy_url, headers=ftg_header, verify=False)
+    response = requests.get(
+        policy_url, headers=ftg_header, params={"format": "dstaddr"}, verify=False
+    )
 
     if response.status_code == 200:
         policy_data = response.json()["results"][0]
@@ -283,6 +333,37 @@ def delete_group_in_policy(policy_id, group_name, ftg_base_url, ftg_header):
         return check_delete
 
 
+def delete_groups_in_policy(policy_id, group_names, ftg_base_url, ftg_header):
+    """API call to delete several groups from a policy with a single update"""
+    update_policy_endpoint = f"/policy/{policy_id}"
+    policy_url = ftg_base_url + update_policy_endpoint
+    delete_dstaddr_names = set(group_names)
+
+    response = requests.get(
+        policy_url, headers=ftg_header, params={"format": "dstaddr"}, verify=False
+    )
+
+    if response.status_code == 200:
+        policy_data = response.json()["results"][0]
+        remaining_dstaddr = [
+            addr
+            for addr in policy_data["dstaddr"]
+            if addr["name"] not in delete_dstaddr_names
+        ]
+
+        if len(remaining_dstaddr) == len(policy_data["dstaddr"]):
+            logging.info("None of the groups are in the policy's dstaddr")
+            return True
+
+        return update_policy(policy_url, ftg_header, remaining_dstaddr)
+
+    else:
+        logging.error(
+            f"Failed to retrieve policy information, reason: {response.text} /  Response code: {response.status_code}"
+        )
+        return False
+
+
 def update_policy(policy_url, ftg_header, policy_data_dstaddr):
     """API call to update a policy"""
     update_response = requests.put(
@@ -0,0 +1,97 @@
+import itertools
+import logging
+import queue
+import threading
+from fire_config import LOG_FILE_NAME, PIPELINE_QUEUE_SIZE
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+_END = object()
+
+
+class Stage:
+    """One step of the pipeline; handle() returns the item to pass on, or None to drop it"""
+
+    def __init__(self, name, handle, finish=None, on_error=None):
+        self.name = name
+        self.handle = handle
+        self.finish = finish
+        # Called with the item and the exception when handle() raises, the item is then dropped
+        self.on_error = on_error
+
+
+class _PriorityChannel:
+    """Bounded queue handing out the lowest-priority-value item first, FIFO within a priority"""
+
+    def __init__(self, maxsize, priority):
+        self._queue = queue.PriorityQueue(maxsize=maxsize)
+        self._priority = priority
+        self._sequence = itertools.count()
+
+    def put(self, item):
+        # The end marker sorts after every item so nothing queued is skipped
+        rank = float("inf") if item is _END else self._priority(item)
+        self._queue.put((rank, next(self._sequence), item))
+
+    def get(self):
+        return self._queue.get()[2]
+
+
+def run_pipeline(source, stages, maxsize=PIPELINE_QUEUE_SIZE, priority=None):
+    """Function to run a source and its stages in threads linked by bounded queues"""
+    if priority is None:
+        queues = [queue.Queue(maxsize=maxsize) for _ in stages]
+    else:
+        queues = [_PriorityChannel(maxsize, priority) for _ in stages]
+
+    def produce():
+        try:
+            # put() blocks while the first queue is full, which throttles the source
+            source(queues[0].put)
+        except Exception as err:
+            logging.error(f"Pipeline source failed: {err}")
+        finally:
+            queues[0].put(_END)
+
+    def consume(stage, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _END:
+                break
+            try:
+                result = stage.handle(item)
+            except Exception as err:
+                logging.error(f"Pipeline stage {stage.name} failed for {item}: {err}")
+                if stage.on_error is not None:
+                    stage.on_error(item, err)
+                continue
+            if result is not None and out_queue is not None:
+                out_queue.put(result)
+
+        if stage.finish is not None:
+            try:
+                stage.finish()
+            except Exception as err:
+                logging.error(f"Pipeline stage {stage.name} failed to finish: {err}")
+        if out_queue is not None:
+            out_queue.put(_END)
+
+    threads = [threading.Thread(target=produce, name="pipeline-source")]
+    for idx, stage in enumerate(stages):
+        out_queue = queues[idx + 1] if idx + 1 < len(stages) else None
+        threads.append(
+            threading.Thread(
+                target=consume,
+                args=(stage, queues[idx], out_queue),
+                name=f"pipeline-{stage.name}",
+            )
+        )
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
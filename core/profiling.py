@@ -0,0 +1,165 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from fire_config import LOG_FILE_NAME, PROFILE_FOLDER
+
+logging.basicConfig(
+    filename=LOG_FILE_NAME,
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 20
+# From 3.12 cProfile runs on sys.monitoring: one profiler sees every thread and a second one cannot start
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+class RunProfiler:
+    """Per-phase cProfile dumps, tracemalloc snapshots and a sleep/network/CPU wall-clock breakdown"""
+
+    def __init__(self, output_folder=PROFILE_FOLDER):
+        self.output_dir = os.path.join(output_folder, datetime.now().strftime("%Y%m%d_%H%M%S"))
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.phases = []
+        self._lock = threading.Lock()
+        # Seconds spent in time.sleep and in HTTP requests, summed over all threads
+        self._totals = {"sleep": 0.0, "network": 0.0}
+        self._thread_profiles = []
+        self._restore = []
+        self._install_timers()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        logging.info(f"Profiling enabled, writing results to {self.output_dir}")
+
+    def _add(self, key, seconds):
+        with self._lock:
+            self._totals[key] += seconds
+
+    def _timed(self, func, key):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._add(key, time.perf_counter() - start)
+
+        return wrapper
+
+    def _install_timers(self):
+        original_sleep = time.sleep
+        time.sleep = self._timed(original_sleep, "sleep")
+        self._restore.append(lambda: setattr(time, "sleep", original_sleep))
+        try:
+            import requests
+        except ImportError:
+            logging.warning("requests is not available, network time will not be measured")
+            return
+        original_request = requests.Session.request
+        requests.Session.request = self._timed(original_request, "network")
+        self._restore.append(lambda: setattr(requests.Session, "request", original_request))
+
+    def _thread_hook(self, frame, event, arg):
+        # Runs once at the start of each new thread and replaces itself with a cProfile profiler
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # Never let profiling kill a worker thread
+            logging.warning(f"Thread profiling unavailable: {err}")
+            return
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager to profile one phase of the run"""
+        index = len(self.phases) + 1
+        prefix = os.path.join(self.output_dir, f"{index:02d}_{name}")
+        start_snapshot = tracemalloc.take_snapshot()
+        start_snapshot.dump(f"{prefix}_start.snapshot")
+        with self._lock:
+            totals = dict(self._totals)
+            self._thread_profiles = []
+
+        profile = cProfile.Profile()
+        if PER_THREAD_PROFILES:
+            threading.setprofile(self._thread_hook)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if PER_THREAD_PROFILES:
+                threading.setprofile(None)
+
+            stats = pstats.Stats(profile)
+            with self._lock:
+                thread_profiles = list(self._thread_profiles)
+                sleep = self._totals["sleep"] - totals["sleep"]
+                network = self._totals["network"] - totals["network"]
+            for thread_profile in thread_profiles:
+                try:
+                    stats.add(thread_profile)
+                except TypeError:
+                    # Threads that returned before making a call leave no stats
+                    pass
+            stats.dump_stats(f"{prefix}.prof")
+
+            end_snapshot = tracemalloc.take_snapshot()
+            end_snapshot.dump(f"{prefix}_end.snapshot")
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            top_allocations = end_snapshot.compare_to(start_snapshot, "lineno")[:TOP_ALLOCATIONS]
+
+            self.phases.append(
+                {
+                    "phase": name,
+                    "wall_seconds": round(wall, 3),
+                    "cpu_seconds": round(cpu, 3),
+                    "sleep_seconds": round(sleep, 3),
+                    "network_seconds": round(network, 3),
+                    "threads_profiled": len(thread_profiles),
+                    "traced_memory_bytes": current,
+                    "peak_traced_memory_bytes": peak,
+                    "top_allocations": [str(stat) for stat in top_allocations],
+                }
+            )
+            logging.info(
+                f"Phase {name}: wall {wall:.2f}s, cpu {cpu:.2f}s, sleep {sleep:.2f}s, network {network:.2f}s"
+            )
+
+    def close(self):
+        """Function to restore the patched timers and write the run summary"""
+        for restore in self._restore:
+            restore()
+        tracemalloc.stop()
+
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as summary_file:
+            json.dump({"phases": self.phases}, summary_file, indent=4)
+
+        with open(os.path.join(self.output_dir, "summary.txt"), "w") as summary_file:
+            summary_file.write(
+                "Sleep and network time are summed over all threads, so they can exceed wall time.\n\n"
+            )
+            summary_file.write(
+                f"{'phase':<12}{'wall':>10}{'cpu':>10}{'sleep':>10}{'network':>10}{'peak MB':>10}\n"
+            )
+            for phase in self.phases:
+                summary_file.write(
+                    f"{phase['phase']:<12}{phase['wall_seconds']:>10.2f}{phase['cpu_seconds']:>10.2f}"
+                    f"{phase['sleep_seconds']:>10.2f}{phase['network_seconds']:>10.2f}"
+                    f"{phase['peak_traced_memory_bytes'] / 1024 / 1024:>10.1f}\n"
+                )
+        logging.info(f"Profile written to {self.output_dir}")
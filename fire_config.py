@@ -18,31 +18,65 @@ BASIC_PATH = os.path.dirname(os.path.abspath(__file__))
 
 LOG_FILE_NAME = f"{BASIC_PATH}/log/{UPDATEDAY}_log_file.log"
 OLD_LOG_FILE = f"{BASIC_PATH}/log/{SEVEN_DAYS_AGO}_log_file.log"
+FRESHNESS_FILE_NAME = f"{BASIC_PATH}/log/{UPDATEDAY}_freshness.csv"  # Per-IP detection/fetch/enforcement times
+OLD_FRESHNESS_FILE = f"{BASIC_PATH}/log/{SEVEN_DAYS_AGO}_freshness.csv"
 QUERY_FILE_NAME = f"{BASIC_PATH}/cip_c2_detect_query.json"
+DEFAULT_QUERY_PRIORITY = 100  # Priority of categories missing from the query file's "priority" map
+ALLOWLIST_FILE_PATH = f"{BASIC_PATH}/allowlist.txt"  # CIDRs that must never be blocked, one per line
 
 # Management files
 CSV_FORMAT = ["Today", "IP Address"]
 CHECK_CSV_FORMAT = ["Date", "IP Address"]
 MAKE_TEMP_CSV_FORMAT = ["Update Date", "IP Address", "Group Name"]
 
-CSV_FILE_PATH = f"{BASIC_PATH}/core/api/input/detect_IP_{date}.csv"  # File to fetch IP data from CIP
 NEXTDAY_CSV_FILE_PATH = f"{BASIC_PATH}/core/api/input/yesterday_detect_IP_{date}.csv"  # File for the previous day's data
 YESTERDAY_CSV_FILE_PATH = f"{BASIC_PATH}/core/api/input/yesterday_detect_IP_{yesterday_date}.csv"  # File to remove duplicate IP entries
 
-# Temp files
-CREATE_TEMP_CSV_FILE_NAME = f"{BASIC_PATH}/core/api/output/create_IP_{date}.csv"
-DELETE_TEMP_CSV_FILE_NAME = f"{BASIC_PATH}/core/api/output/delete_IP_{date}.csv"
-CREATE_TEMP_JSON_FILE_NAME = f"{BASIC_PATH}/core/api/output/create_IP_{date}.json"
-DELETE_TEMP_JSON_FILE_NAME = f"{BASIC_PATH}/core/api/output/delete_IP_{date}.json"
+PROFILE_FOLDER = f"{BASIC_PATH}/profile"  # Output of main.py --profile, one timestamped folder per run
+
+# Persisted state kept across runs
+STATE_FOLDER = f"{BASIC_PATH}/state"
+BLOCKED_IP_FILTER_PATH = f"{STATE_FOLDER}/blocked_ip.bloom"  # Bloom filter of every IP ever blocked
+BLOCKED_IP_FILTER_CAPACITY = 5000000
+BLOCKED_IP_FILTER_ERROR_RATE = 0.001
+CIP_BUDGET_FILE_PATH = f"{STATE_FOLDER}/cip_budget.json"  # Credits used today and yield history per query
+WORK_QUEUE_DB_PATH = f"{STATE_FOLDER}/work_queue.sqlite3"  # "sqlite" backend, local disk only: SQLite locking is unreliable on NFS/SMB
+WORK_QUEUE_DIR = f"{STATE_FOLDER}/work_queue"  # "directory" backend, point it at a mount shared by every host
+WATERMARK_FILE_PATH = f"{STATE_FOLDER}/watermarks.json"  # Last successful fetch per query
+
+# Audit files, only written when WRITE_AUDIT_FILES is enabled
+WRITE_AUDIT_FILES = False
+AUDIT_FOLDER = f"{BASIC_PATH}/log/audit"
+CREATE_AUDIT_CSV_FILE_NAME = f"{AUDIT_FOLDER}/create_IP_{date}.csv"
+DELETE_AUDIT_CSV_FILE_NAME = f"{AUDIT_FOLDER}/delete_IP_{date}.csv"
+OLD_CREATE_AUDIT_CSV_FILE_NAME = f"{AUDIT_FOLDER}/create_IP_{sevenday.strftime('%Y-%m-%d')}.csv"
+OLD_DELETE_AUDIT_CSV_FILE_NAME = f"{AUDIT_FOLDER}/delete_IP_{sevenday.strftime('%Y-%m-%d')}.csv"
 
 # Delete file paths
-OUT_FOLDER = f"{BASIC_PATH}/core/api/output"  # Folder path for files to be changed
 INPUT_FOLDER = f"{BASIC_PATH}/core/api/input"  # Folder path for files to be changed
 EXCEPT_FILES = NEXTDAY_CSV_FILE_PATH  # File names to be retained
 
 NEW_GROUP_NAME = f"C2_{UPDATEDAY}"
+GROUP_CHUNK_SIZE = 600  # Address objects per group
 DELET_GROUP_NAME = f"C2_{SEVEN_DAYS_AGO}"
 
+# Streaming pipeline from CIP fetch to firewall push
+PIPELINE_QUEUE_SIZE = 1000  # Maximum IPs waiting between two stages
+
+# Sharded collection (main.py --mode coordinator / worker)
+# "sqlite": coordinator and workers on one host, "directory": workers on several hosts sharing WORK_QUEUE_DIR
+WORK_QUEUE_BACKEND = "sqlite"
+WORK_UNIT_PAGES = 20  # Result pages (10 IPs each) per work unit
+WORK_LEASE_SECONDS = 300  # A unit whose worker stops renewing is handed to another worker
+WORK_POLL_SECONDS = 10  # Wait between claims while other workers still hold leases
+WORK_MAX_ATTEMPTS = 3  # Claims of a unit before it is given up on
+WORK_RUN_WAIT_SECONDS = 3600  # Time a worker waits for a coordinator to queue a run before giving up
+
+# Expiry of old groups and address objects
+EXPIRY_MAX_WORKERS = 8  # Concurrent DELETE calls against the firewall
+EXPIRY_RETRY_COUNT = 3  # Attempts for each failed group/object deletion
+EXPIRY_RETRY_DELAY_SECONDS = 2
+
 ip_data = set()
 
 # CIP DATA
@@ -51,6 +85,15 @@ CRIMINALIP_API_KEY = ""
 BASE_URL = "https://api.criminalip.io/"
 ENDPOINT = "v1/banner/search"
 HEADERS = {"x-api-key": CRIMINALIP_API_KEY, "Cache-Control": "no-cache"}
+CIP_DAILY_CREDIT_LIMIT = None  # Credits the tool may spend per day, None for no limit
+CIP_CREDITS_PER_REQUEST = 1
+CIP_QUOTA_HEADER = "X-RateLimit-Remaining"  # Remaining-credit header, honoured when the API sends it
+CIP_QUOTA_STATUS_CODES = (402,)  # Responses meaning the credits are used up, never retried
+CIP_RATE_LIMIT_STATUS_CODES = (429,)  # Rate limited, retried after Retry-After or an exponential backoff
+CIP_RATE_LIMIT_MAX_DELAY_SECONDS = 300
+CIP_RATE_LIMIT_RETRY_COUNT = 5  # Attempts for a rate-limited count request while planning
+CIP_TIMESTAMP_UTC_OFFSET_HOURS = 0  # Time zone of the scan_dtime values in search results
+CIP_EXTRA_RESULT_FIELDS = ()  # Extra result fields to keep, e.g. ("open_port_no", "tags")
 
 # todo #Fortigate
 TARGET = ""
@@ -59,3 +102,11 @@ POLICYID = ""
 
 FTG_BASE_URL = f"https://{TARGET}/api/v2/cmdb/firewall"
 FTG_HEADERS = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+FTG_PAGE_SIZE = 1000  # Table entries per GET when reading address groups
+
+# "address": address objects in date-named groups applied to POLICYID, expired by this tool
+# "banned": quarantine through the banned user monitor API, expired by the firewall itself
+FTG_BACKEND = "address"
+FTG_MONITOR_URL = f"https://{TARGET}/api/v2/monitor"
+BANNED_EXPIRY_SECONDS = 7 * 24 * 60 * 60  # Same retention as the address groups
+BANNED_BATCH_SIZE = 1000  # IPs per add_users request
@@ -1,50 +1,68 @@
-import time
+import argparse
 import os
+import time
 import logging
+from contextlib import nullcontext
+from datetime import datetime
 from fire_config import (
     LOG_FILE_NAME,
     QUERY_FILE_NAME,
-    CSV_FILE_PATH,
     NEXTDAY_CSV_FILE_PATH,
     YESTERDAY_CSV_FILE_PATH,
-    CREATE_TEMP_CSV_FILE_NAME,
-    CREATE_TEMP_JSON_FILE_NAME,
-    DELETE_TEMP_CSV_FILE_NAME,
-    DELETE_TEMP_JSON_FILE_NAME,
+    WRITE_AUDIT_FILES,
+    AUDIT_FOLDER,
+    CREATE_AUDIT_CSV_FILE_NAME,
+    DELETE_AUDIT_CSV_FILE_NAME,
+    OLD_CREATE_AUDIT_CSV_FILE_NAME,
+    OLD_DELETE_AUDIT_CSV_FILE_NAME,
     NEW_GROUP_NAME,
+    UPDATEDAY,
+    GROUP_CHUNK_SIZE,
     POLICYID,
     SEVEN_DAYS_AGO,
-    OUT_FOLDER,
     INPUT_FOLDER,
     EXCEPT_FILES,
     OLD_LOG_FILE,
+    OLD_FRESHNESS_FILE,
     FTG_BASE_URL,
     FTG_HEADERS,
+    FTG_BACKEND,
+    FTG_MONITOR_URL,
+    BANNED_EXPIRY_SECONDS,
+    BANNED_BATCH_SIZE,
+    CIP_EXTRA_RESULT_FIELDS,
+    sevenday,
 )
-from core.api.cip_request_get_ip import process_ioc
+from core.api.cip_request_get_ip import process_ioc, plan_query_budget
+from core.api.budget import CreditBudget, pages_for_count
+from core.api.work_queue import open_work_queue, run_worker, default_worker_id
+from core.api.watermark import Watermarks
 from core.api.managefiles import (
     QueryData,
-    find_unique_ip_addresses,
+    read_retained_ip_rows,
+    split_old_ip_rows,
     create_csv_file,
-    convert_csv_to_json,
-    filter_old_data_and_get_ip_addresses,
-    extract_and_save_to_json,
-    merge_files_and_create_nextday_file,
+    merge_and_create_nextday_file,
     delete_files_in_folder,
     remove_file_with_log,
 )
 from core.fwb._ftg_request_parm import (
     check_name_exist_address,
+    check_get_group_info,
     add_address_object,
+    delete_address_object,
     make_address_group,
+    delete_address_group,
     check_group_in_policy_dstaddr,
     update_group_in_policy,
-    check_get_group_members_info,
-    check_address_group_existence,
-    delete_group_in_policy,
-    delete_address_group,
-    delete_address_object,
 )
+from core.fwb._ftg_banned_parm import get_banned_ip_addresses, ban_ip_addresses
+from core.fwb._ftg_expiry import expire_old_groups, run_with_retry
+from core.fwb._blocked_ip_filter import BlockedIPFilter
+from core.pipeline import Stage, run_pipeline
+from core.allowlist import Allowlist
+from core.profiling import RunProfiler
+from core.freshness import FreshnessTracker, utc_now
 
 logging.basicConfig(
     filename=LOG_FILE_NAME,
@@ -53,44 +71,118 @@ logging.basicConfig(
 )
 
 
-def load_queries(query_file_name):
-    return QueryData.from_file(query_file_name)
+def load_queries(query_file_name, watermarks=None):
+    return QueryData.from_file(query_file_name, watermarks)
+
+
+def fetch_ip_addresses(queries, emit, watermarks=None, budget=None):
+    """Function to collect IP data for every query and hand each new IP to the pipeline"""
+
+    def on_new_ip(c2_name, item):
+        record = {
+            "category": c2_name,
+            "query": item.get("query"),
+            "priority": queries.priority_of(c2_name),
+            "ip_address": item["ip_address"],
+            "detected_at": item.get("scan_dtime"),
+            "fetched_at": item.get("fetched_at") or utc_now(),
+        }
+        # Optional projected fields such as ports or tags travel with the record
+        record.update((field, item.get(field)) for field in CIP_EXTRA_RESULT_FIELDS)
+        emit(record)
+
+    # The most severe categories are fetched first so they reach the firewall first
+    for c2_name, query_list in queries.ordered_items():
+        process_ioc(
+            c2_name, query_list, on_new_ip=on_new_ip, watermarks=watermarks, budget=budget
+        )
+
+
+def start_sharded_run(work_queue):
+    """Function to register a new run before planning, so workers started alongside wait for its units"""
+    # Units left behind by a coordinator that died would otherwise be fetched and never merged
+    work_queue.purge()
+    run_id = f"{default_worker_id()}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    work_queue.start_run(run_id)
+    return run_id
+
+
+def collect_sharded_ip_addresses(queries, budget, work_queue, run_id):
+    """Function to split the planned pages into work units and fetch them alongside the workers"""
+    for c2_name, query_list in queries.ordered_items():
+        for now_query in query_list:
+            pages = budget.page_limits.get(now_query)
+            if pages is None:
+                pages = pages_for_count(budget.counts.get(now_query))
+            if not pages:
+                if now_query not in budget.counts:
+                    logging.error(f"No result count for {c2_name} query {now_query}, skipped this run")
+                else:
+                    logging.info(f"No pages planned for {c2_name} query {now_query}")
+                continue
+            priority = queries.priority_of(c2_name)
+            # The first page was read with the count while planning, so only the rest is queued
+            first_page = budget.first_pages.pop(now_query, None)
+            start_page = 0
+            if first_page is not None:
+                work_queue.add_results(run_id, c2_name, now_query, priority, first_page)
+                start_page = 1
+            work_queue.enqueue(run_id, c2_name, now_query, priority, pages, start_page=start_page)
+            # Workers do not share the budget, so the planned pages are charged up front
+            for _ in range(start_page, pages):
+                budget.charge(now_query)
+    work_queue.queue_run(run_id)
+    logging.info(f"Work units queued for run {run_id}: {work_queue.open_units(run_id)}")
+
+    run_worker(work_queue, run_id=run_id)
+
+
+def emit_merged_ip_addresses(merged_rows, emit):
+    """Function to hand the deduplicated results of a sharded run to the pipeline"""
+    for row in merged_rows:
+        emit(
+            {
+                "category": row["c2_name"],
+                "query": row["query"],
+                "priority": row["priority"],
+                "ip_address": row["ip_address"],
+                "detected_at": row["scan_dtime"],
+                "fetched_at": datetime.fromisoformat(row["fetched_at"]),
+            }
+        )
 
 
-def chunk_list(lst, chunk_size):
-    """Function to divide a list into chunks of specified size"""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i : i + chunk_size]
+def write_audit_file(ip_list, audit_file_name):
+    """Function to keep a copy of the IP list when audit files are enabled"""
+    if WRITE_AUDIT_FILES and ip_list:
+        os.makedirs(AUDIT_FOLDER, exist_ok=True)
+        create_csv_file(ip_list, audit_file_name)
 
 
-def check_new_ip_address(CSV_FILE_PATH, YESTERDAY_CSV_FILE_PATH):
-    """Function to check for new IP address data"""
-    logging.info("CSV file is ready.")
-    new_ip_list = find_unique_ip_addresses(CSV_FILE_PATH, YESTERDAY_CSV_FILE_PATH)
+def check_new_ip_address(new_ip_list):
+    """Function to record the new IP address data collected by the pipeline"""
     logging.info(f"Unique IP addresses: {new_ip_list}")
-    if new_ip_list:
-        create_csv_file(new_ip_list, CREATE_TEMP_CSV_FILE_NAME)
-        convert_csv_to_json(CREATE_TEMP_CSV_FILE_NAME, CREATE_TEMP_JSON_FILE_NAME)
+    write_audit_file(new_ip_list, CREATE_AUDIT_CSV_FILE_NAME)
     return new_ip_list
 
 
-def check_delete_ip_address(YESTERDAY_CSV_FILE_PATH):
+def check_delete_ip_address(retained_rows):
     """Function to check for IP addresses that need deletion"""
-    delete_ip_list = filter_old_data_and_get_ip_addresses(YESTERDAY_CSV_FILE_PATH)
+    kept_rows, delete_ip_list = split_old_ip_rows(retained_rows, sevenday)
     logging.info(f"IP addresses to delete: {delete_ip_list}")
-
-    if delete_ip_list:
-        create_csv_file(delete_ip_list, DELETE_TEMP_CSV_FILE_NAME)
-        extract_and_save_to_json(DELETE_TEMP_CSV_FILE_NAME, DELETE_TEMP_JSON_FILE_NAME)
-    return delete_ip_list
+    write_audit_file(delete_ip_list, DELETE_AUDIT_CSV_FILE_NAME)
+    return kept_rows, delete_ip_list
 
 
-def check_already_blocked_ip_address(ip_list):
+def check_already_blocked_ip_address(ip_list, blocked_filter=None):
     """Function to check IP addresses already blocked"""
     existing_ips = []
     non_existing_ips = []
     for ipv4address in ip_list:
-        if check_name_exist_address(ipv4address, FTG_BASE_URL, FTG_HEADERS):
+        # A filter miss means the IP was never blocked, so the firewall lookup is skipped
+        if blocked_filter is not None and ipv4address not in blocked_filter:
+            non_existing_ips.append(ipv4address)
+        elif check_name_exist_address(ipv4address, FTG_BASE_URL, FTG_HEADERS):
             existing_ips.append(ipv4address)
         else:
             non_existing_ips.append(ipv4address)
@@ -98,33 +190,11 @@ def check_already_blocked_ip_address(ip_list):
     return existing_ips, non_existing_ips
 
 
-def add_ip_address_in_friewall(block_list):
-    """Function to add IP addresses to the firewall for blocking"""
-    for ip in block_list:
-        add_address_object(ip, FTG_BASE_URL, FTG_HEADERS)
-        time.sleep(0.5)
-
-
-def handle_failure(func_name):
-    """Function to handle errors"""
-    if func_name == "check_address_group_existence":
-        logging.error(f"{func_name} failed / The group to delete does not currently exist.")
-    elif func_name == "check_group_in_policy_dstaddr":
-        logging.error(
-            f"{func_name} failed / The group exists but is not reflected in the policy's destination address."
-        )
-    elif func_name == "delete_group_in_policy":
-        logging.error(
-            f"{func_name} failed / Unable to delete the group from the policy."
-        )
-    elif func_name == "delete_address_group":
-        logging.error(f"{func_name} failed / Cannot delete a group that belongs to a policy.")
-
-
-def make_group_object(chunked_ips):
-    """Function to create groups for holding address objects"""
+def make_group_object(chunked_ips, start_index=0):
+    """Function to create groups for holding address objects and return the groups applied to the policy"""
     generated_group_names = []
-    for idx, ip_chunk in enumerate(chunked_ips):
+    applied_group_names = []
+    for idx, ip_chunk in enumerate(chunked_ips, start=start_index):
         group_name = f"{NEW_GROUP_NAME}_{idx + 1}"
         generated_group = make_address_group(group_name, ip_chunk, FTG_BASE_URL, FTG_HEADERS)
         if generated_group:
@@ -132,81 +202,359 @@ def make_group_object(chunked_ips):
     for name in generated_group_names:
         exit_group = check_group_in_policy_dstaddr(POLICYID, name, FTG_BASE_URL, FTG_HEADERS)
         if exit_group is False:
-            update_group_in_policy(POLICYID, name, FTG_BASE_URL, FTG_HEADERS)
-
-
-def delete_ip_list_in_friewall(delete_ip_list):
-    """Function to delete blocked IP data from the firewall"""
-    if delete_ip_list:
-        delete_groups = check_get_group_members_info(SEVEN_DAYS_AGO, FTG_BASE_URL, FTG_HEADERS)
-        for group in delete_groups:
-            delete_block_after_7_days(POLICYID, group["name"], group["members"])
-
+            exit_group = update_group_in_policy(POLICYID, name, FTG_BASE_URL, FTG_HEADERS)
+        if exit_group:
+            applied_group_names.append(name)
+    return applied_group_names
+
+
+def next_group_index():
+    """Function to continue the group numbering of the runs made earlier today"""
+    try:
+        group_names = check_get_group_info(UPDATEDAY, FTG_BASE_URL, FTG_HEADERS)
+    except Exception as err:
+        logging.error(f"Error reading today's groups: {err}")
+        group_names = None
+    if group_names is None:
+        logging.error("Unable to read today's groups, group numbering restarts at 1")
+        return 0
+    numbers = [
+        int(suffix)
+        for suffix in (name[len(NEW_GROUP_NAME) + 1:] for name in group_names)
+        if suffix.isdigit()
+    ]
+    return max(numbers, default=0)
+
+
+class GroupPusher:
+    """Adds address objects as they arrive and attaches them to the policy in groups"""
+
+    def __init__(self, chunk_size=GROUP_CHUNK_SIZE, blocked_filter=None, freshness=None):
+        self.chunk_size = chunk_size
+        self.blocked_filter = blocked_filter
+        self.freshness = freshness
+        self.pending_records = []
+        self.pending_priority = None
+        self.pushed_ips = []
+        self.failed_records = []
+        self.group_count = next_group_index()
+
+    def fail(self, record, err=None):
+        """Function to record an IP that did not reach the firewall"""
+        self.failed_records.append(record)
+
+    def push(self, record):
+        """Function to add an IP address to the firewall for blocking"""
+        # Each priority gets its own groups so severe IPs are enforced without waiting on others
+        if record["priority"] != self.pending_priority:
+            self.flush()
+            self.pending_priority = record["priority"]
+        added = add_address_object(record["ip_address"], FTG_BASE_URL, FTG_HEADERS)
+        time.sleep(0.5)
+        if not added:
+            self.fail(record)
+            return None
+        if self.blocked_filter is not None:
+            self.blocked_filter.add(record["ip_address"])
+        self.pending_records.append(record)
+        if len(self.pending_records) >= self.chunk_size:
+            self.flush()
+        return record
+
+    def flush(self):
+        """Function to group the pending address objects and apply them to the policy"""
+        if not self.pending_records:
+            return
+        logging.info(
+            f"Grouping {len(self.pending_records)} IPs of priority {self.pending_priority}"
+        )
+        records, self.pending_records = self.pending_records, []
+        pending_ips = [record["ip_address"] for record in records]
+        try:
+            applied = make_group_object([pending_ips], self.group_count)
+        except Exception as err:
+            logging.error(f"Error applying group {self.group_count + 1}: {err}")
+            applied = []
+        if applied:
+            self.pushed_ips.extend(pending_ips)
+            if self.freshness is not None:
+                self.freshness.enforced(records)
+        else:
+            self.roll_back(f"{NEW_GROUP_NAME}_{self.group_count + 1}", records)
+        self.group_count += 1
+
+    def roll_back(self, group_name, records):
+        """Function to remove a group that did not reach the policy so its IPs are pushed again next run"""
+        # An address object outside any group blocks nothing but would pass the existence check
+        logging.error(f"Group {group_name} was not applied to the policy, removing its {len(records)} IPs")
+        try:
+            delete_address_group(group_name, FTG_BASE_URL, FTG_HEADERS)
+        except Exception as err:
+            logging.error(f"Error deleting group {group_name}: {err}")
+        run_with_retry(
+            lambda ipv4address: delete_address_object(f"C2_{ipv4address}", FTG_BASE_URL, FTG_HEADERS),
+            [record["ip_address"] for record in records],
+        )
+        self.failed_records.extend(records)
+
+
+class BannedPusher:
+    """Bans IP addresses in bulk through the banned user list, with the retention as expiry"""
+
+    def __init__(self, batch_size=BANNED_BATCH_SIZE, freshness=None):
+        self.batch_size = batch_size
+        self.freshness = freshness
+        self.pending_records = []
+        self.pending_priority = None
+        self.pushed_ips = []
+        self.failed_records = []
+
+    def fail(self, record, err=None):
+        """Function to record an IP that did not reach the firewall"""
+        self.failed_records.append(record)
+
+    def push(self, record):
+        """Function to queue an IP address for the next ban request"""
+        if record["priority"] != self.pending_priority:
+            self.flush()
+            self.pending_priority = record["priority"]
+        self.pending_records.append(record)
+        if len(self.pending_records) >= self.batch_size:
+            self.flush()
+        return record
+
+    def flush(self):
+        """Function to ban the pending IP addresses in one request"""
+        if not self.pending_records:
+            return
+        records, self.pending_records = self.pending_records, []
+        pending_ips = [record["ip_address"] for record in records]
+        try:
+            banned = ban_ip_addresses(pending_ips, BANNED_EXPIRY_SECONDS, FTG_MONITOR_URL, FTG_HEADERS)
+        except Exception as err:
+            logging.error(f"Error banning {len(pending_ips)} IPs: {err}")
+            banned = False
+        if banned:
+            self.pushed_ips.extend(pending_ips)
+            if self.freshness is not None:
+                self.freshness.enforced(records)
+        else:
+            self.failed_records.extend(records)
 
-def delete_block_after_7_days(POLICYID, DELET_GROUP_NAME, delete_ip_list):
-    """Function to delete blocked rules after 7 days"""
-    check_address_group = check_address_group_existence(DELET_GROUP_NAME, FTG_BASE_URL, FTG_HEADERS)
-    if not check_address_group:
-        handle_failure("check_address_group_existence")
 
-    check_group_in_policy = (
-        check_group_in_policy_dstaddr(POLICYID, DELET_GROUP_NAME, FTG_BASE_URL, FTG_HEADERS)
-        if check_address_group
-        else False
-    )
-    if check_address_group and not check_group_in_policy:
-        handle_failure("check_group_in_policy_dstaddr")
-    check_delete_group_in_policy = (
-        delete_group_in_policy(POLICYID, DELET_GROUP_NAME, FTG_BASE_URL, FTG_HEADERS)
-        if check_group_in_policy
-        else False
-    )
-    if check_group_in_policy and not check_delete_group_in_policy:
-        handle_failure("delete_group_in_policy")
-    check_delete_address_group = (
-        delete_address_group(DELET_GROUP_NAME, FTG_BASE_URL, FTG_HEADERS)
-        if check_delete_group_in_policy
-        else False
+def load_blocked_ip_filter(yesterday_ip_set):
+    """Function to open the blocked IP filter, seeding a new one with the retained IPs"""
+    blocked_filter = BlockedIPFilter()
+    # Expired IPs are never removed from a Bloom filter, so it is rebuilt from the retention window once full
+    if blocked_filter.full:
+        logging.info(
+            f"Blocked IP filter holds {blocked_filter.inserted} addresses, rebuilding from the retained IPs"
+        )
+        blocked_filter.reset()
+    if blocked_filter.created:
+        for ip_address in yesterday_ip_set:
+            blocked_filter.add(ip_address)
+        logging.info(f"Blocked IP filter seeded with {len(yesterday_ip_set)} IPs")
+    return blocked_filter
+
+
+def run_block_pipeline(
+    queries,
+    yesterday_ip_set,
+    blocked_filter=None,
+    allowlist=None,
+    watermarks=None,
+    budget=None,
+    source=None,
+):
+    """Function to stream IPs from CIP through diff and existence check to the firewall"""
+    if source is None:
+        source = lambda emit: fetch_ip_addresses(queries, emit, watermarks, budget)
+    new_ip_list = []
+    existing_ips = []
+    allowlist = allowlist if allowlist is not None else Allowlist()
+    freshness = FreshnessTracker()
+    if FTG_BACKEND == "banned":
+        pusher = BannedPusher(freshness=freshness)
+        banned_ips = get_banned_ip_addresses(FTG_MONITOR_URL, FTG_HEADERS) or set()
+    else:
+        pusher = GroupPusher(blocked_filter=blocked_filter, freshness=freshness)
+
+    def skip_allowed_ip(record):
+        if allowlist.suppress(record["ip_address"]):
+            return None
+        return record
+
+    def diff_new_ip(record):
+        if record["ip_address"] in yesterday_ip_set:
+            return None
+        new_ip_list.append(record["ip_address"])
+        if budget is not None:
+            budget.record_new_ip(record["query"])
+        return record
+
+    def skip_blocked_ip(record):
+        if FTG_BACKEND == "banned":
+            existing = [record["ip_address"]] if record["ip_address"] in banned_ips else []
+        else:
+            existing, _ = check_already_blocked_ip_address([record["ip_address"]], blocked_filter)
+        if existing:
+            existing_ips.extend(existing)
+            return None
+        return record
+
+    run_pipeline(
+        source,
+        [
+            Stage("allowlist", skip_allowed_ip),
+            Stage("diff", diff_new_ip),
+            # An IP that raises after the diff stage is treated like a failed push
+            Stage("check", skip_blocked_ip, on_error=pusher.fail),
+            Stage("push", pusher.push, pusher.flush, on_error=pusher.fail),
+        ],
+        priority=lambda record: record["priority"],
     )
-    if check_delete_group_in_policy and not check_delete_address_group:
-        handle_failure("delete_address_group")
-
-    if check_delete_address_group:
-        for ip in delete_ip_list:
-            delete_address_object(ip, FTG_BASE_URL, FTG_HEADERS)
 
+    allowlist.report()
+    logging.info(f"Number of pre-existing IPs: {len(existing_ips)}")
+    logging.info(f"Total IPs added to the firewall today: {len(pusher.pushed_ips)}")
+    freshness.report()
+
+    # IPs that did not reach the firewall stay out of the next day file so the next run retries them
+    if pusher.failed_records:
+        logging.error(f"IPs left unblocked, retried next run: {len(pusher.failed_records)}")
+        failed_ips = {record["ip_address"] for record in pusher.failed_records}
+        new_ip_list = [ip for ip in new_ip_list if ip not in failed_ips]
+        # Their queries keep the old watermark, otherwise the next run would stop before reaching them
+        if watermarks is not None:
+            for query in {record["query"] for record in pusher.failed_records}:
+                watermarks.discard(query)
+    return new_ip_list
 
-def main():
-    queries = load_queries(QUERY_FILE_NAME)
-    for c2_name, query_list in queries.data.items():
-        process_ioc(c2_name, query_list)
-
-    if os.path.exists(CSV_FILE_PATH):
-        new_ip_list = check_new_ip_address(CSV_FILE_PATH, YESTERDAY_CSV_FILE_PATH)
-        delete_ip_list = check_delete_ip_address(YESTERDAY_CSV_FILE_PATH)
 
-    merge_files_and_create_nextday_file(
-        CREATE_TEMP_CSV_FILE_NAME, YESTERDAY_CSV_FILE_PATH, NEXTDAY_CSV_FILE_PATH
+def delete_ip_list_in_friewall(delete_ip_list):
+    """Function to delete blocked IP data from the firewall"""
+    if delete_ip_list:
+        summary = expire_old_groups(POLICYID, SEVEN_DAYS_AGO, FTG_BASE_URL, FTG_HEADERS)
+        logging.info(
+            f"Expiry summary: groups found {summary['groups_found']}, "
+            f"groups deleted {summary['groups_deleted']}, "
+            f"objects deleted {summary['objects_deleted']}"
+        )
+        if summary["lookup_failed"]:
+            logging.error("Expiry failed: the expired groups could not be looked up")
+        if summary["groups_failed"] or summary["objects_failed"]:
+            logging.error(
+                f"Expiry failures: groups {summary['groups_failed']}, objects {summary['objects_failed']}"
+            )
+
+
+def main(profiler=None, mode="local"):
+    def phase(name):
+        return profiler.phase(name) if profiler is not None else nullcontext()
+
+    # A run earlier today already merged yesterday's file into today's one
+    retained_csv_file = (
+        NEXTDAY_CSV_FILE_PATH
+        if os.path.exists(NEXTDAY_CSV_FILE_PATH)
+        else YESTERDAY_CSV_FILE_PATH
     )
-    logging.info("Files merged and next day file created.")
-
-    if new_ip_list:
-        existing_ips, non_existing_ips = check_already_blocked_ip_address(new_ip_list)
-        logging.info(f"Number of pre-existing IPs: {len(existing_ips)}")
-        logging.info(f"Total IPs added to the firewall today: {len(non_existing_ips)}")
-        if non_existing_ips:
-            add_ip_address_in_friewall(non_existing_ips)
-            chunked_ips = list(chunk_list(non_existing_ips, 600))
-            make_group_object(chunked_ips)
-        delete_ip_list_in_friewall(delete_ip_list)
-    else:
-        delete_ip_list_in_friewall(delete_ip_list)
 
-    # delete files
-    delete_files_in_folder(OUT_FOLDER)
-    delete_files_in_folder(INPUT_FOLDER, EXCEPT_FILES)
-    remove_file_with_log(OLD_LOG_FILE)
+    sharded = mode == "coordinator"
+    with phase("load"):
+        # Work units are cut by offset before any page is read, so the watermark early stop does not apply
+        watermarks = Watermarks() if not sharded else None
+        queries = load_queries(QUERY_FILE_NAME, watermarks)
+        retained_rows = read_retained_ip_rows(retained_csv_file)
+        yesterday_ip_set = {row["IP Address"] for row in retained_rows}
+        blocked_filter = (
+            load_blocked_ip_filter(yesterday_ip_set) if FTG_BACKEND == "address" else None
+        )
+        allowlist = Allowlist.from_file()
+
+    work_queue = open_work_queue() if sharded else None
+    with phase("plan"):
+        if sharded:
+            run_id = start_sharded_run(work_queue)
+        budget = CreditBudget()
+        for query, template in queries.templates.items():
+            budget.bind(query, template)
+        plan_query_budget(queries.ordered_items(), budget)
+
+    source = None
+    if sharded:
+        with phase("collect"):
+            collect_sharded_ip_addresses(queries, budget, work_queue, run_id)
+            # The SQLite connection belongs to this thread, so the rows are read before the pipeline starts
+            merged_rows = work_queue.merged_results(run_id)
+            source = lambda emit: emit_merged_ip_addresses(merged_rows, emit)
+
+    with phase("pipeline"):
+        try:
+            new_ip_list = run_block_pipeline(
+                queries, yesterday_ip_set, blocked_filter, allowlist, watermarks, budget, source
+            )
+        finally:
+            if blocked_filter is not None:
+                blocked_filter.close()
+        if watermarks is not None:
+            watermarks.commit()
+        budget.report()
+        if work_queue is not None:
+            work_queue.purge(run_id)
+            work_queue.close()
+
+    with phase("files"):
+        check_new_ip_address(new_ip_list)
+        kept_rows, delete_ip_list = check_delete_ip_address(retained_rows)
+
+        merge_and_create_nextday_file(new_ip_list, kept_rows, NEXTDAY_CSV_FILE_PATH)
+        logging.info("Files merged and next day file created.")
+
+    # Banned IPs expire on the firewall itself, so there is nothing to delete
+    if FTG_BACKEND == "address":
+        with phase("expiry"):
+            delete_ip_list_in_friewall(delete_ip_list)
+
+    with phase("cleanup"):
+        # delete files
+        delete_files_in_folder(INPUT_FOLDER, EXCEPT_FILES)
+        remove_file_with_log(OLD_LOG_FILE)
+        remove_file_with_log(OLD_FRESHNESS_FILE)
+        remove_file_with_log(OLD_CREATE_AUDIT_CSV_FILE_NAME)
+        remove_file_with_log(OLD_DELETE_AUDIT_CSV_FILE_NAME)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Block malicious IPs from Criminal IP on FortiGate")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write per-phase cProfile, tracemalloc and timing data to a timestamped folder",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("local", "coordinator", "worker"),
+        default="local",
+        help="local fetches and blocks alone; coordinator queues work units for workers sharing "
+        "the work queue, fetches with them and blocks the merged result; worker only fetches",
+    )
+    parser.add_argument("--worker-id", help="worker name in the work queue, defaults to host-pid")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    profiler = RunProfiler() if args.profile else None
+    try:
+        if args.mode == "worker":
+            work_queue = open_work_queue()
+            try:
+                run_worker(work_queue, args.worker_id)
+            finally:
+                work_queue.close()
+        else:
+            main(profiler, args.mode)
+    finally:
+        if profiler is not None:
+            profiler.close()